@@ -112,7 +112,7 @@ Each action is typically represented as an integer:
         function to calculate the objective metric
         
         Args:
-            states (list): The states.
+            states (dict): The summary of the observations seen during the training (see TrainingInfoCallback).
         
         Returns:
             list: The objective metric.
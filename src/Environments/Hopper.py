@@ -92,7 +92,7 @@ the x- and y-coordinates are returned in info with the keys "x_position" and "y_
         Objective metric for the CartPole environment.
         Calculates a score for the given state on a particular observation of the CartPole environment.
 
-        :param state: The state of the CartPole environment.
+        :param states: The summary of the observations seen during the training (see TrainingInfoCallback).
         :return: a table of tuples containing the string name of the metric and the value of the metric.
         """
         return {}
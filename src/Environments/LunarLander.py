@@ -84,7 +84,7 @@ class LunarLander(EnvType):
         This function calculates the objective metric for the Lunar Lander environment.
         
         Args:
-            states (list): The states of the environment.
+            states (dict): The summary of the observations seen during the training (see TrainingInfoCallback).
         
         Returns:
             list[dict[str, float]]: The objective metric for the environment.
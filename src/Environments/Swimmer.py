@@ -87,32 +87,23 @@ By default, the observation space is `Box(-Inf, Inf, (8,), float64)` with the fo
         Calculates a score for the given state during a particular observation of the Swimmer environment.
 
         Args:
-            states (np.ndarray): The states of the environment.
+            states (dict): The summary of the observations seen during the training (see TrainingInfoCallback).
 
         Returns:
             dict[str, float]: The objective metric for the state.
         """
         # Calculate the average forward velocity (x-axis velocity)
-        forward_velocity = 0.0
-        for state in states:
-            forward_velocity += state[3]  # x-axis velocity is at index 3
-        forward_velocity /= len(states)
+        forward_velocity = states["mean"][3]  # x-axis velocity is at index 3
 
         # Calculate the average lateral velocity (y-axis velocity)
-        lateral_velocity = 0.0
-        for state in states:
-            lateral_velocity += abs(state[4])  # y-axis velocity is at index 4
-        lateral_velocity /= len(states)
+        lateral_velocity = states["abs_mean"][4]  # y-axis velocity is at index 4
 
         # Calculate the angular velocity of the front end
-        angular_velocity = 0.0
-        for state in states:
-            angular_velocity += abs(state[5])  # angular velocity of front end is at index 5
-        angular_velocity /= len(states)
+        angular_velocity = states["abs_mean"][5]  # angular velocity of front end is at index 5
 
         # Calculate the total distance traveled along the x-axis
-        initial_position = states[0][0]  # Assume x-position is at index 0
-        final_position = states[-1][0]  # Assume x-position is at index 0
+        initial_position = states["first"][0]  # Assume x-position is at index 0
+        final_position = states["last"][0]  # Assume x-position is at index 0
         distance_traveled = final_position - initial_position
 
         # Compile the results into a dictionary
@@ -125,4 +116,3 @@ By default, the observation space is `Box(-Inf, Inf, (8,), float64)` with the fo
         
 
         return result
-
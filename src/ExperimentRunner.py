@@ -0,0 +1,294 @@
+import json
+import os
+import random
+import re
+import signal
+import traceback
+from logging import getLogger
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable
+
+import numpy as np
+
+from PolicyTrainer.TrainingScheduler import SharedLimiter, SharedSlots
+from VIRAL import VIRAL
+
+
+def _run_worker(job: Callable, run_idx: int, training_slots: SharedSlots, llm_limiter: SharedLimiter, conn: Connection) -> None:
+    """
+    Entry point of a run process, send back the result or the traceback of the run.
+    The run leads its own process group, with its training workers, so they can all be killed.
+
+    Args:
+        job (Callable): the run, called with (run_idx, training_slots, llm_limiter)
+        run_idx (int): the index of the run
+        training_slots (SharedSlots): the training slots shared by all the runs
+        llm_limiter (SharedLimiter): the bound of the LLM requests shared by all the runs
+        conn (Connection): the pipe to send the result
+    """
+    os.setpgid(0, 0)
+    # the forked runs would draw the same seeds
+    random.seed()
+    np.random.seed()
+    try:
+        conn.send((job(run_idx, training_slots, llm_limiter), None))
+    except Exception:
+        conn.send((None, traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def viral_run(
+    run_idx: int,
+    training_slots: SharedSlots,
+    llm_limiter: SharedLimiter,
+    viral_kwargs: dict,
+    n_init: int = 2,
+    n_refine: int = 1,
+    focus: str = "",
+) -> dict:
+    """
+    One VIRAL run: generate the context, generate and refine the reward functions
+
+    Args:
+        run_idx (int): the index of the run
+        training_slots (SharedSlots): the training slots shared by all the runs
+        llm_limiter (SharedLimiter): the bound of the LLM requests shared by all the runs
+        viral_kwargs (dict): the parameters of VIRAL
+        n_init (int, optional): the number of initial reward functions. Defaults to 2.
+        n_refine (int, optional): the number of refinement loops. Defaults to 1.
+        focus (str, optional): the focus of the reward functions. Defaults to "".
+
+    Returns:
+        dict: the seed, the success rates of the states, the number of states better than the baseline
+            and the number of states rejected by the prescreen
+    """
+    viral = VIRAL(**viral_kwargs, training_slots=training_slots, llm_limiter=llm_limiter)
+    viral.generate_context()
+    viral.generate_reward_function(n_init=n_init, n_refine=n_refine, focus=focus)
+    baseline = viral.memory[0].performances
+    srs = [float(state.performances["sr"]) for state in viral.memory[1:]]
+    for state in viral.memory:
+        viral.logger.info(state)
+    return {
+        "seed": viral.policy_trainer.seed,
+        "baseline_sr": float(baseline["sr"]) if baseline is not None else None,
+        "srs": srs,
+        "best_sr": max(srs, default=0.0),
+        "nb_better": sum(baseline is not None and sr > baseline["sr"] for sr in srs),
+        "nb_prescreened": sum(state.performances.get("prescreened", False) for state in viral.memory[1:]),
+    }
+
+
+class ExperimentRunner:
+    """
+    Run independent VIRAL runs in parallel processes, so the LLM phases of a run
+    overlap the trainings of the others. The trainings of all the runs share
+    the same slots of cores and the LLM requests share the same bound.
+    """
+    def __init__(
+        self,
+        max_runs: int = 2,
+        max_trainings: int = None,
+        cores_per_training: int = 1,
+        max_llm_requests: int = 1,
+    ):
+        """
+        Initialize the runner
+
+        Args:
+            max_runs (int, optional): maximum number of concurrent runs. Defaults to 2.
+            max_trainings (int, optional): maximum number of concurrent trainings of all the runs.
+                Defaults to nb_cores // cores_per_training.
+            cores_per_training (int, optional): number of cores of each training, usually the number
+                of vectorized envs. Defaults to 1.
+            max_llm_requests (int, optional): maximum number of concurrent LLM requests of all the runs,
+                usually OLLAMA_NUM_PARALLEL. Defaults to 1.
+        """
+        assert (os.name == "posix"), "multi-proccess features only available on LINUX system..."
+        self.logger = getLogger("VIRAL")
+        self.max_runs = max(1, max_runs)
+        self.training_slots = SharedSlots(max_trainings, cores_per_training)
+        self.llm_limiter = SharedLimiter(max(1, max_llm_requests))
+
+    def run(
+        self,
+        job: Callable[[int, SharedSlots, SharedLimiter], dict],
+        nb_runs: int,
+        name: str = "experiment",
+        interactive: bool = False,
+    ) -> dict:
+        """
+        Run nb_runs times the job, at most max_runs at the same time
+
+        Args:
+            job (Callable[[int, SharedSlots, SharedLimiter], dict]): the run, called with (run_idx, training_slots, llm_limiter),
+                for instance functools.partial(viral_run, viral_kwargs=...)
+            nb_runs (int): the number of runs
+            name (str, optional): the name of the report file. Defaults to "experiment".
+            interactive (bool, optional): the job reads the standard input (human feedback), the runs
+                are then run one after the other in this process. Defaults to False.
+
+        Returns:
+            dict: the report, with the result or the error of every run
+        """
+        if interactive:
+            results = {run_idx: self._run_here(job, run_idx) for run_idx in range(nb_runs)}
+        else:
+            results = self._run_parallel(job, nb_runs)
+        report = self.aggregate([results[run_idx] for run_idx in range(nb_runs)])
+        self.save_report(report, name)
+        return report
+
+    def _run_here(self, job: Callable[[int, SharedSlots, SharedLimiter], dict], run_idx: int) -> dict:
+        """
+        Run the job in this process
+
+        Args:
+            job (Callable[[int, SharedSlots, SharedLimiter], dict]): the run
+            run_idx (int): the index of the run
+
+        Returns:
+            dict: the result or the error of the run
+        """
+        self.logger.info(f"run {run_idx} started")
+        try:
+            result = job(run_idx, self.training_slots, self.llm_limiter)
+        except Exception:
+            error = traceback.format_exc()
+            self.logger.error(f"run {run_idx} has crashed:\n{error}")
+            return {"error": error}
+        self.logger.info(f"run {run_idx} has finished: {result}")
+        return result
+
+    def _run_parallel(self, job: Callable[[int, SharedSlots, SharedLimiter], dict], nb_runs: int) -> dict[int, dict]:
+        """
+        Run the jobs in processes, at most max_runs at the same time
+
+        Args:
+            job (Callable[[int, SharedSlots, SharedLimiter], dict]): the run
+            nb_runs (int): the number of runs
+
+        Returns:
+            dict[int, dict]: the result or the error of every run
+        """
+        pending = list(range(nb_runs))
+        running: dict[int, tuple[Process, Connection]] = {}
+        results: dict[int, dict] = {}
+        try:
+            self._schedule(job, pending, running, results)
+        finally: # on an interruption, no run or training is left behind
+            for process, conn in running.values():
+                process.kill() # the run may not lead its group yet
+                self._kill_group(process.pid)
+                process.join()
+                conn.close()
+        return results
+
+    def _schedule(
+        self,
+        job: Callable[[int, SharedSlots, SharedLimiter], dict],
+        pending: list[int],
+        running: dict[int, tuple[Process, Connection]],
+        results: dict[int, dict],
+    ) -> None:
+        """
+        Start the pending runs while there is room and collect the finished ones, until all are done
+
+        Args:
+            job (Callable[[int, SharedSlots, SharedLimiter], dict]): the run
+            pending (list[int]): the runs to start
+            running (dict[int, tuple[Process, Connection]]): the process and the pipe of the started runs
+            results (dict[int, dict]): the result or the error of the finished runs
+        """
+        while pending or running:
+            while pending and len(running) < self.max_runs:
+                run_idx = pending.pop(0)
+                reader, writer = Pipe(duplex=False)
+                process = Process(
+                    target=_run_worker,
+                    args=(job, run_idx, self.training_slots, self.llm_limiter, writer),
+                )
+                process.start()
+                writer.close()
+                running[run_idx] = (process, reader)
+                self.logger.info(f"run {run_idx} started")
+            handles = {}
+            for run_idx, (process, conn) in running.items():
+                handles[conn] = run_idx
+                handles[process.sentinel] = run_idx
+            for run_idx in dict.fromkeys(handles[handle] for handle in wait(list(handles.keys()))):
+                process, conn = running.pop(run_idx)
+                try:
+                    result, error = conn.recv()
+                except EOFError:
+                    process.join()
+                    result, error = None, f"run exited with code {process.exitcode}"
+                process.join()
+                conn.close()
+                self._kill_group(process.pid) # the training workers left by a crashed run still use their cores
+                nb_lost = self.training_slots.release_owner(process.pid)
+                if nb_lost > 0:
+                    self.logger.warning(f"run {run_idx} has left {nb_lost} training slots, they are given back")
+                nb_lost = self.llm_limiter.release_owner(process.pid)
+                if nb_lost > 0:
+                    self.logger.warning(f"run {run_idx} has left {nb_lost} LLM requests, they are given back")
+                if error is not None:
+                    self.logger.error(f"run {run_idx} has crashed:\n{error}")
+                    result = {"error": error}
+                else:
+                    self.logger.info(f"run {run_idx} has finished: {result}")
+                results[run_idx] = result
+
+    @staticmethod
+    def _kill_group(pid: int) -> None:
+        """
+        Kill the processes left in the group of a run
+
+        Args:
+            pid (int): the pid of the run, leader of the group
+        """
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError): # no process left in the group
+            pass
+
+    @staticmethod
+    def aggregate(results: list[dict]) -> dict:
+        """
+        Aggregate the results of the runs, the numeric fields are averaged over the finished runs
+
+        Args:
+            results (list[dict]): the result of every run
+
+        Returns:
+            dict: the number of runs, of crashed runs, the mean and the sum of the numeric fields and the runs
+        """
+        finished = [result for result in results if "error" not in result]
+        numeric_keys = {
+            key for result in finished for key, value in result.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and key != "seed"
+        }
+        return {
+            "nb_runs": len(results),
+            "nb_crashed": len(results) - len(finished),
+            "mean": {key: float(np.mean([r[key] for r in finished if r.get(key) is not None])) for key in numeric_keys},
+            "sum": {key: float(np.sum([r[key] for r in finished if r.get(key) is not None])) for key in numeric_keys},
+            "runs": results,
+        }
+
+    def save_report(self, report: dict, name: str) -> None:
+        """
+        Write the report in data/experiments
+
+        Args:
+            report (dict): the aggregated report
+            name (str): the name of the report file
+        """
+        safe_name = re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        path = os.path.join("data", "experiments", f"{safe_name}_report.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+        self.logger.info(f"report saved at: {path}")
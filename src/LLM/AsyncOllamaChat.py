@@ -0,0 +1,342 @@
+import asyncio
+import copy
+from time import perf_counter
+from typing import AsyncGenerator, Coroutine, Dict, Optional, Union
+
+import httpx
+
+from LLM.OllamaChat import OLLAMA_CHAT_API_URL, OllamaChat
+
+
+class AsyncOllamaChat(OllamaChat):
+    """
+    Asynchronous Ollama chat session, the requests of all the sessions share
+    a pooled keep-alive client so several generations can be in flight at once.
+    The coroutines have the names and the arguments of the OllamaChat methods.
+    """
+    _clients: dict[tuple, httpx.AsyncClient] = {}
+
+    def __init__(
+        self,
+        model: str = "qwen2.5-coder",
+        system_prompt: Optional[str] = None,
+        options: Optional[Dict] = None,
+        proxies: dict = None,
+        token_budget: int = None,
+        keep_alive: str = "30m",
+        request_limiter=None,
+        stop_after_code: bool = False,
+        response_format: Union[str, Dict] = None,
+        timeout: float = 600.0,
+        connect_timeout: float = 10.0,
+        retries: int = 3,
+        backoff: float = 1.0,
+        max_connections: int = 8,
+    ) -> None:
+        """
+        Initialize an asynchronous Ollama chat session.
+
+        Args:
+            model (str, optional): The name of the Ollama model.
+            system_prompt (str, optional): Initial system message to set chat context.
+            options (dict, optional): Advanced model generation parameters.
+            proxies (dict, optional): Proxy configuration for the HTTP requests.
+            token_budget (int, optional): Maximum number of prompt tokens sent, the oldest turns
+                beyond are dropped. Defaults to num_ctx - num_predict of the options, None to keep all.
+            keep_alive (str, optional): How long the server keeps the model and its prompt cache loaded
+                after a request. Defaults to "30m".
+            request_limiter (Semaphore, optional): Semaphore shared by the chats of several
+                processes to bound their concurrent requests. Defaults to None.
+            stop_after_code (bool, optional): Close a streamed response as soon as the first code block
+                is complete. Defaults to False.
+            response_format (str | dict, optional): Structured output of the responses, "json" or a JSON
+                schema. Defaults to None.
+            timeout (float, optional): Maximum time between two chunks of a response in seconds. Defaults to 600.0.
+            connect_timeout (float, optional): Maximum time to open a connection in seconds. Defaults to 10.0.
+            retries (int, optional): Number of retries of a request on connection errors and server errors. Defaults to 3.
+            backoff (float, optional): Delay before the first retry in seconds, doubled at each retry. Defaults to 1.0.
+            max_connections (int, optional): Maximum number of pooled connections. Defaults to 8.
+        """
+        super().__init__(
+            model, system_prompt, options, proxies, token_budget, keep_alive,
+            request_limiter=request_limiter, stop_after_code=stop_after_code, response_format=response_format,
+            timeout=timeout, connect_timeout=connect_timeout, retries=retries, backoff=backoff,
+        )
+        self.http_timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_connections = max_connections
+
+    @classmethod
+    def from_chat(cls, chat: OllamaChat, max_connections: int = 8) -> "AsyncOllamaChat":
+        """
+        Get an asynchronous session with the settings and a copy of the history of a chat,
+        the new messages are not added to the chat
+
+        Args:
+            chat (OllamaChat): the chat
+            max_connections (int, optional): Maximum number of pooled connections. Defaults to 8.
+
+        Returns:
+            AsyncOllamaChat: the session
+        """
+        connect_timeout, timeout = chat.timeout
+        async_chat = cls(
+            model=chat.model,
+            options=chat.options.copy(),
+            proxies=chat.proxies,
+            token_budget=chat.token_budget,
+            keep_alive=chat.keep_alive,
+            request_limiter=chat.request_limiter,
+            stop_after_code=chat.stop_after_code,
+            response_format=chat.response_format,
+            timeout=timeout,
+            connect_timeout=connect_timeout,
+            retries=chat.retries,
+            backoff=chat.backoff,
+            max_connections=max_connections,
+        )
+        async_chat.messages = copy.deepcopy(chat.messages)
+        return async_chat
+
+    @classmethod
+    def run(cls, *coroutines: Coroutine) -> list:
+        """
+        Run coroutines of the sessions at the same time from synchronous code,
+        the pooled clients are closed at the end
+
+        Args:
+            coroutines (Coroutine): the coroutines, for instance generate_response() of several sessions
+
+        Returns:
+            list: the result of each coroutine
+        """
+        async def gather() -> list:
+            try:
+                return list(await asyncio.gather(*coroutines))
+            finally:
+                await cls.aclose()
+
+        return asyncio.run(gather())
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        Get the client shared by the sessions with the same proxies in the running event loop
+
+        Returns:
+            httpx.AsyncClient: the pooled client
+        """
+        proxy = (self.proxies or {}).get("http")
+        key = (id(asyncio.get_running_loop()), proxy)
+        client = AsyncOllamaChat._clients.get(key)
+        if client is None or client.is_closed:
+            limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(proxy=proxy, limits=limits),
+                timeout=self.http_timeout,
+            )
+            AsyncOllamaChat._clients[key] = client
+        return client
+
+    @classmethod
+    async def aclose(cls) -> None:
+        """
+        Close the pooled clients
+        """
+        for client in cls._clients.values():
+            await client.aclose()
+        cls._clients.clear()
+
+    async def _acquire_async(self) -> None:
+        """
+        Wait for a free request slot if the requests are bounded, without blocking the event loop
+        """
+        if self.request_limiter is not None:
+            await asyncio.to_thread(self._acquire)
+
+    async def _send(self, payload: dict, stream: bool) -> httpx.Response:
+        """
+        Send a chat request, retry with an exponential backoff on connection errors and server errors
+
+        Args:
+            payload (dict): the body of the request
+            stream (bool): keep the response open to read it chunk by chunk
+
+        Raises:
+            httpx.HTTPError: the last error when all the retries failed
+
+        Returns:
+            httpx.Response: the response, to close if streamed
+        """
+        client = self._get_client()
+        for attempt in range(self.retries + 1):
+            try:
+                request = client.build_request("POST", OLLAMA_CHAT_API_URL, json=payload)
+                response = await client.send(request, stream=stream)
+                if response.status_code < 500 or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+                await response.aclose()
+                self.logger.warning(f"Server error {response.status_code}, retry {attempt + 1}/{self.retries}")
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                self.logger.warning(f"Connection error: {e}, retry {attempt + 1}/{self.retries}")
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def generate_response(
+        self, stream: bool = False, llm_options: Optional[Dict] = {}
+    ) -> Union[str, AsyncGenerator]:
+        """
+        Generate a response with advanced configuration options.
+
+        Args:
+            stream (bool, optional): Stream response in real-time
+            llm_options (dict, optional): Temporary generation options
+
+        Returns:
+            Response as string or asynchronous streaming generator
+        """
+        generation_options = {**self.options, **(llm_options or {})}
+
+        payload = {
+            "model": self.model,
+            "messages": self.get_context(),
+            "stream": stream,
+            "options": generation_options,
+            "keep_alive": self.keep_alive,
+        }
+        if self.response_format is not None:
+            payload["format"] = self.response_format
+
+        streaming = False
+        await self._acquire_async()
+        try:
+            start = perf_counter()
+            response = await self._send(payload, stream)
+            self._strip_images()
+            if not stream:
+                full_response = response.json()
+                self._log_prompt_tokens(full_response.get("prompt_eval_count"))
+                assistant_response = full_response.get("message", {}).get("content", "")
+                self.add_message(assistant_response, role="assistant")
+                return assistant_response
+
+            async def stream_response():
+                stream = self._new_stream(start)
+                try:
+                    async for line in response.aiter_lines():
+                        if line:
+                            text, stop = self._read_stream_line(line, stream)
+                            if text:
+                                yield text
+                            if stop:
+                                break
+                    if self._held_back(stream):
+                        yield self._held_back(stream)
+                finally:
+                    await response.aclose() # on an early stop, the server stops generating
+                    self._release() # the generation slot is held until the end of the stream
+                self._end_stream(stream)
+
+            streaming = True
+            return stream_response()
+
+        except httpx.HTTPError as e:
+            self.logger.error(f"Connection error: {e}")
+            return ""
+        finally:
+            if not streaming:
+                self._release()
+
+    async def generate_responses(
+        self, k: int, llm_options: Optional[Dict] = {}, max_workers: int = None
+    ) -> list[str]:
+        """
+        Generate k independent responses to the same history with concurrent requests,
+        each request has its own seed. The responses are not added to the history,
+        each one is an alternative reply to the last message.
+
+        Args:
+            k (int): the number of responses
+            llm_options (dict, optional): Temporary generation options
+            max_workers (int, optional): the maximum number of concurrent requests. Defaults to k.
+
+        Returns:
+            list[str]: the k responses, an empty string for a failed request
+        """
+        generation_options = {**self.options, **(llm_options or {})}
+        seed = generation_options.get("seed", 0)
+        messages = self.get_context()
+        semaphore = asyncio.Semaphore(max_workers or k)
+
+        async def request(i: int) -> str:
+            payload = {
+                "model": self.model,
+                "messages": messages,
+                "stream": False,
+                "options": {**generation_options, "seed": seed + i},
+                "keep_alive": self.keep_alive,
+            }
+            if self.response_format is not None:
+                payload["format"] = self.response_format
+            async with semaphore:
+                await self._acquire_async()
+                try:
+                    response = await self._send(payload, stream=False)
+                    full_response = response.json()
+                    self._log_prompt_tokens(full_response.get("prompt_eval_count"))
+                    return full_response.get("message", {}).get("content", "")
+                except httpx.HTTPError as e:
+                    self.logger.error(f"Connection error (seed {seed + i}): {e}")
+                    return ""
+                finally:
+                    self._release()
+
+        responses = await asyncio.gather(*(request(i) for i in range(k)))
+        self._strip_images()
+        return list(responses)
+
+    async def print_Generator_and_return(
+        self, response: AsyncGenerator | str, number: int = 1
+    ) -> str:
+        """
+        Prints the content of a response if it is an asynchronous generator, or simply returns the response as is.
+
+        Args:
+            response (AsyncGenerator | str): The response to print or return. If it's a generator,
+                                        it will be printed chunk by chunk. If it's a string,
+                                        it will be returned directly.
+            number (int, optional): The index of the response (default is 1). Used for logging purposes.
+
+        Returns:
+            The original response if it is a string, or the concatenated string of all chunks
+            if it was a generator.
+        """
+        self.logger.info(f"Response {number}:")
+        if isinstance(response, AsyncGenerator):
+            response_gen = response
+            response = ""
+            async for chunk in response_gen:
+                print(chunk, end="", flush=True)
+                response += chunk
+        return response
+
+
+async def main():
+    actor = AsyncOllamaChat(
+        model="qwen2.5-coder",
+        system_prompt="You are an expert in Reinforcement Learning specialized in designing reward functions.",
+    )
+    critic = AsyncOllamaChat(
+        model="qwen2.5-coder",
+        system_prompt="You are a reinforcement learning expert, as a critic you explain step by step the environment.",
+    )
+    actor.add_message("Implement a reward function for the Gymnasium Acrobot environment.")
+    critic.add_message("Describe the observation space of the Gymnasium Acrobot environment.")
+    # the two generations are in flight at the same time
+    actor_response, critic_response = await asyncio.gather(actor.generate_response(), critic.generate_response())
+    print(f"Actor: {actor_response}\n\nCritic: {critic_response}")
+    await AsyncOllamaChat.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,154 @@
+import ast
+import hashlib
+import json
+import os
+import re
+from logging import getLogger
+
+import numpy as np
+
+from utils.utils import atomic_write, file_lock
+
+
+class CodeCache:
+    """
+    Content-addressed cache of the generated reward functions, persisted on disk.
+    Two sources with the same AST (whitespaces, comments and docstrings aside) share the same entry.
+    """
+    def __init__(self, env_name: str, directory: str = "data/code_cache"):
+        """
+        Load the cache of an environment
+
+        Args:
+            env_name (str): the name of the environment
+            directory (str, optional): the folder of the cache files. Defaults to "data/code_cache".
+        """
+        self.logger = getLogger("VIRAL")
+        safe_env_name = re.sub(r'[^a-zA-Z0-9_]', '_', env_name)
+        self.path = os.path.join(directory, f"{safe_env_name}.json")
+        self.entries: dict[str, dict] = {}
+        self.compiled: dict[str, object] = {}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def key(source: str) -> str:
+        """
+        Hash the normalized AST of a source
+
+        Args:
+            source (str): the source of the reward function
+
+        Returns:
+            str: the key of the source, None if the source is not valid python
+        """
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            return None
+        for node in ast.walk(tree):
+            body = getattr(node, "body", None)
+            if (
+                isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Module))
+                and body
+                and isinstance(body[0], ast.Expr)
+                and isinstance(body[0].value, ast.Constant)
+                and isinstance(body[0].value.value, str)
+            ):
+                node.body = body[1:] or [ast.Pass()]
+        return hashlib.sha256(ast.dump(tree).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> dict:
+        """
+        Get the entry of a key
+
+        Args:
+            key (str): the key of the source
+
+        Returns:
+            dict: the entry (source, valid, error, trainings), None if unknown
+        """
+        if key is None:
+            return None
+        return self.entries.get(key)
+
+    def set_validation(self, key: str, source: str, valid: bool, error: str = None) -> None:
+        """
+        Record the validation result of a source
+
+        Args:
+            key (str): the key of the source
+            source (str): the source of the reward function
+            valid (bool): True if the reward function has passed the validation
+            error (str, optional): the validation error. Defaults to None.
+        """
+        if key is None:
+            return
+        entry = self.entries.setdefault(key, {"trainings": {}})
+        entry.update({"source": source, "valid": valid, "error": error})
+        self.save()
+
+    def set_training(self, key: str, config: str, policy: str, performances: dict) -> None:
+        """
+        Record the result of a training
+
+        Args:
+            key (str): the key of the source
+            config (str): the training configuration (algorithm and timesteps)
+            policy (str): the path of the checkpoint
+            performances (dict): the performances of the training
+        """
+        if key is None or key not in self.entries:
+            return
+        self.entries[key]["trainings"][config] = {"policy": policy, "performances": performances}
+        self.save()
+
+    def get_training(self, key: str, config: str) -> dict:
+        """
+        Get a finished training of a source, if its checkpoint still exists
+
+        Args:
+            key (str): the key of the source
+            config (str): the training configuration (algorithm and timesteps)
+
+        Returns:
+            dict: the policy path and the performances, None if unknown
+        """
+        if key is None or key not in self.entries:
+            return None
+        training = self.entries[key]["trainings"].get(config)
+        if training is None or not os.path.exists(training["policy"]):
+            return None
+        return training
+
+    def save(self) -> None:
+        """
+        Write the cache on disk, with the entries written by the other runs since the load
+        """
+        with file_lock(self.path): # the parallel runs share the file, merge their entries
+            if os.path.exists(self.path):
+                with open(self.path) as file:
+                    for key, entry in json.load(file).items():
+                        if key not in self.entries:
+                            self.entries[key] = entry
+                        else:
+                            self.entries[key]["trainings"] = {**entry["trainings"], **self.entries[key]["trainings"]}
+            atomic_write(self.path, lambda file: json.dump(self.entries, file, default=self._to_json))
+
+    @staticmethod
+    def _to_json(value):
+        """
+        Convert the numpy values of the performances
+
+        Args:
+            value: a value not serializable by json
+
+        Returns:
+            a serializable value
+        """
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        return str(value)
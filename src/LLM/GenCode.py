@@ -1,25 +1,122 @@
+import ast
+import json
+import os
 from logging import getLogger
+from time import perf_counter
 from typing import Callable
 
 import numpy as np
+from gymnasium import make
 from stable_baselines3.common.env_util import make_vec_env
+from stable_baselines3.common.vec_env import VecEnv
 
 from Environments import EnvType
+from LLM.CodeCache import CodeCache
 from LLM.OllamaChat import OllamaChat
+from LLM.Sandbox import Sandbox
 from State.State import State
 
+try:
+    import numba
+except ImportError: # optional, the reward functions stay interpreted
+    numba = None
+
+
+REPAIR_SYSTEM_PROMPT = """
+        You're a python expert fixing reward functions.
+        Strict criteria:
+        1. Fix ONLY the given function, keep its name and its signature
+        2. Give no additional explanations
+        3. Assuming Numpy already imported as np
+        """
+
+REWARD_FUNCTION_NAME = "reward_func"
+REWARD_FUNCTION_ARGS = ["observations", "is_success", "is_failure"]
+# structured output of the actor, the server constrains the generation to this schema
+REWARD_FUNCTION_SCHEMA = {
+    "type": "object",
+    "properties": {"code": {"type": "string"}},
+    "required": ["code"],
+}
+STRUCTURED_RULE = f"""        7. Answer in JSON, the python code of the function {REWARD_FUNCTION_NAME} in the "code" field
+        """
+
+
+class JitRewardFunction:
+    """
+    A reward function compiled by numba, the python function is called instead from the first
+    call the compiled one fails on, for instance with arguments of types not seen by the probe
+    """
+    def __init__(self, jitted: Callable, py_func: Callable):
+        """
+        Initialize the function
+
+        Args:
+            jitted (Callable): the function compiled by numba
+            py_func (Callable): the python function
+        """
+        self.jitted = jitted
+        self.py_func = py_func # the name of the attribute of the numba functions, used by the batch callers
+
+    def __call__(self, *args):
+        """
+        Call the compiled function, or the python function once the compiled one has failed
+
+        Returns:
+            float: the reward
+        """
+        if self.jitted is not None:
+            try:
+                return self.jitted(*args)
+            except Exception as e:
+                getLogger("VIRAL").warning(
+                    f"the reward function compiled by numba fails ({type(e).__name__}), the python function is used"
+                )
+                self.jitted = None
+        return self.py_func(*args)
+
 
 class GenCode:
     """
     Generate the code from a response, it can be handle error, and refine from the llm new responses
     """
-    def __init__(self, env: EnvType, llm: OllamaChat):
+    _validation_envs: dict[str, VecEnv] = {} # one env per env type, shared by the instances
+    _probe_observations: dict[str, np.ndarray] = {}
+    _step_arguments: dict[str, list[tuple]] = {}
+
+    def __init__(
+        self,
+        env: EnvType,
+        llm: OllamaChat,
+        code_cache: CodeCache = None,
+        sandbox: bool = True,
+        nb_fuzz_steps: int = 200,
+        max_latency: float = 1e-3,
+        max_repairs: int = 3,
+        max_samples: int = 2,
+        side_repair: bool = True,
+        structured: bool = False,
+        jit: bool = True,
+    ):
         """
         Generate the code from a response, it can be handle error, and refine from the llm new responses
 
         Args:
             env (Environments): the environment to test the code
             llm (OllamaChat): the llm to handle the response
+            code_cache (CodeCache, optional): the cache of the already validated functions. Defaults to None.
+            sandbox (bool, optional): run the probe calls of the function in a process with CPU time,
+                memory and wall-clock limits (only on LINUX). Defaults to True.
+            nb_fuzz_steps (int, optional): number of random steps giving the probe observations. Defaults to 200.
+            max_latency (float, optional): maximum mean duration of a call in seconds. Defaults to 1e-3.
+            max_repairs (int, optional): maximum number of repairs of a sampled function. Defaults to 3.
+            max_samples (int, optional): maximum number of sampled functions, each with its repairs. Defaults to 2.
+            side_repair (bool, optional): repair in a short side conversation with only the broken
+                function and the error, instead of the whole history. Defaults to True.
+            structured (bool, optional): the responses are JSON objects with the code in a "code" field,
+                generated with the response_format REWARD_FUNCTION_SCHEMA. Defaults to False.
+            jit (bool, optional): compile the validated functions with numba when it is installed,
+                the compiled function is used if it matches the original and is faster. Defaults to True.
         """
         self.current_index = 0
         self.llm = llm
@@ -27,7 +124,20 @@ class GenCode:
         self.success_func = env.success_func
         self.logger = getLogger("VIRAL")
         self.response = None
+        self.history_length = 0 # length of the main conversation at the start of the current sample
+        self.sample_message: int = None # index of the response of the current sample in the main conversation
         self.reward_func = None
+        self.code_cache = code_cache
+        self.key = None
+        self.sandbox = Sandbox() if sandbox and os.name == "posix" else None
+        self.nb_fuzz_steps = nb_fuzz_steps
+        self.max_latency = max_latency
+        self.max_repairs = max_repairs
+        self.max_samples = max_samples
+        self.side_repair = side_repair
+        self.structured = structured
+        self.jit = jit
+        self.generation: dict = None
 
     def get(self, response: str) -> State:
         """
@@ -36,74 +146,399 @@ class GenCode:
         Args:
             response (str): response code from the llm
 
+        Raises:
+            RuntimeError: if no runnable function is found within the repairs and the samples
+
         Returns:
             State: contain the Callable reward function and is string associeted
         """
         self.response = response
-        self.current_index += 1
+        self._start_sample()
+        self.generation = { # the prompt of the first generation, made by the caller, is counted
+            "attempts": 0, "repairs": 0, "samples": 1, "prompt_tokens": self.llm.prompt_tokens, "latency": 0.0,
+            "jit_speedup": None,
+        }
         self.reward_func = self.get_runnable_function()
-        return State(self.current_index, self.reward_func, self.response)
+        self.current_index += 1
+        state = State(self.current_index, self.reward_func, self.response)
+        state.set_generation(self.generation)
+        self.logger.info(f"state {self.current_index} generation: {self.generation}")
+        return state
 
-    def get_runnable_function(self, error: str = None) -> Callable:
+    def get_runnable_function(self) -> Callable:
         """
         Process and validate a reward function for a gym environment.
 
-        This method attempts to generate and validate a reward function by:\n
-        1. Handling potential previous errors
-        2. Creating a gym environment
-        3. Cleaning and compiling the code
-        4. Testing the reward function with a sample action
-        5. Recursively handling various potential errors
+        A failed function is repaired at most max_repairs times, then a fresh function is sampled
+        with a new seed, at most max_samples functions are sampled.
 
-        Args:
-            response (str): The code response containing the reward function definition.
-            error (str, optional): Previous error message to be added to LLM context.
-                                    Defaults to None.
+        Raises:
+            RuntimeError: if no runnable function is found within the repairs and the samples
 
         Returns:
-            tuple: A tuple containing:
-                - Callable: The compiled and validated reward function
-                - str: The original response code
-
-        Raises:
-            - ValueError: Invalid function definition
-            - SyntaxError: Syntax issues in the function
-            - RuntimeError: Execution problems during function testing
+            Callable: The compiled and validated reward function
+        """
+        for sample in range(self.max_samples):
+            if sample > 0:
+                self.resample(sample)
+            for repair in range(self.max_repairs + 1):
+                if repair > 0:
+                    self.repair(error)
+                reward_func, error = self.validate()
+                if reward_func is not None:
+                    return reward_func
+            self.logger.warning(f"no runnable function after {self.max_repairs} repairs, sample a new one")
+        raise RuntimeError(
+            f"no runnable reward function after {self.max_samples} samples of {self.max_repairs} repairs"
+        )
+
+    def validate(self) -> tuple[Callable, str]:
+        """
+        Clean, fuzz, compile and test the current response
 
-        Note:
-            - Uses recursion to handle potential errors
-            - Relies on get_code, compile_reward_function, and test_reward_function methods
-            - Provides a robust mechanism for generating valid reward functions
+        Returns:
+            tuple[Callable, str]: the compiled reward function and None if it is valid,
+                else None and the error to give to the LLM
         """
-        if error is not None:
-            self.llm.add_message(error)
-            self.response = self.llm.generate_response(stream=True)
-            self.response = self.llm.print_Generator_and_return(self.response)
+        self.generation["attempts"] += 1
+        self.key = None
         try:
-            env = make_vec_env(self.env_name)
             self.get_clean_response()
+            cached = self.get_cached_function()
+            if cached is not None:
+                return cached, None
+            observations = self.get_probe_observations()
+            calls = [(obs, 0, 0) for obs in observations]
+            calls += [(observations[-1], 1, 0), (observations[-1], 0, 1)] # terminal corner cases
+            calls += self.get_step_arguments() # the argument types of the training, probed by numba
+            outputs, timings = self.run_probe(calls)
+            self.check_outputs(calls, outputs, timings)
             reward_func = self.compile_reward_function()
-            _ = env.reset()
-            action = env.envs[0].action_space.sample()
-            obs, _, dones, infos = env.step([action])
-            infos[0]["terminated"] = False
-            infos[0]["obs"] = obs[0]
-            is_success, is_failure = self.success_func(env.envs[0], infos[0])
-            self.test_reward_function(
-                reward_func, observations=obs[0], is_success=0,
-                is_failure=0
-            )
+            if self.sandbox is None: # else the calls in this process are limited to the probes passed in the sandbox
+                self.test_reward_function(
+                    reward_func, observations=observations[0], is_success=0,
+                    is_failure=0
+                )
+            reward_func = self.jit_reward_function(reward_func, calls)
         except ValueError as e:
             self.logger.warning(str(e))
-            return self.get_runnable_function(str(e))
+            self.cache_validation(str(e))
+            return None, str(e)
         except SyntaxError as e:
             self.logger.warning(f"Error syntax {e}")
-            return self.get_runnable_function(str(e))
+            self.cache_validation(str(e))
+            return None, str(e)
         except RuntimeError as e:
             self.logger.warning(f"Error execution {e}")
-            return self.get_runnable_function(str(e))
+            self.cache_validation(str(e))
+            return None, str(e)
+
+        self.cache_validation(reward_func=reward_func)
+        return reward_func, None
+
+    def jit_reward_function(self, reward_func: Callable, calls: list[tuple]) -> Callable:
+        """
+        Compile the reward function with numba in nopython mode, the compiled function is kept
+        if it gives the same rewards as the original on the probe calls and is faster.
+        The probe calls should hold the argument types of the training, see get_step_arguments,
+        a call with other types may still fail and switch to the python function. They should
+        have passed run_probe, the function is called in this process.
+
+        Args:
+            reward_func (Callable): the validated reward function
+            calls (list[tuple]): the positional arguments of the probe calls
+
+        Returns:
+            Callable: the compiled function in a JitRewardFunction, or reward_func if numba is missing,
+                fails or is slower
+        """
+        if numba is None or not self.jit:
+            return reward_func
+        try:
+            jitted = numba.njit(reward_func)
+            with np.errstate(all="ignore"):
+                expected = np.array([reward_func(*args) for args in calls], dtype=np.float64)
+                rewards = np.array([jitted(*args) for args in calls], dtype=np.float64) # compiled by the first call
+        except Exception as e:
+            self.logger.debug(f"the reward function is not compiled by numba: {type(e).__name__}")
+            return reward_func
+        if not np.allclose(rewards, expected, rtol=1e-5, atol=1e-8, equal_nan=True):
+            self.logger.warning("the reward function compiled by numba does not match the original, it is not used")
+            return reward_func
+        speedup = self.time_calls(reward_func, calls) / self.time_calls(jitted, calls)
+        self.generation["jit_speedup"] = speedup
+        self.logger.info(f"numba speed-up of the reward function: {speedup:.1f}x")
+        return JitRewardFunction(jitted, reward_func) if speedup > 1.0 else reward_func
+
+    @staticmethod
+    def time_calls(reward_func: Callable, calls: list[tuple], repeat: int = 3) -> float:
+        """
+        Measure the duration of the probe calls
+
+        Args:
+            reward_func (Callable): the reward function
+            calls (list[tuple]): the positional arguments of each call
+            repeat (int, optional): the number of measures, the fastest is kept. Defaults to 3.
+
+        Returns:
+            float: the duration of all the calls in seconds
+        """
+        durations = []
+        with np.errstate(all="ignore"):
+            for _ in range(repeat):
+                start = perf_counter()
+                for args in calls:
+                    reward_func(*args)
+                durations.append(perf_counter() - start)
+        return min(durations)
+
+    def repair(self, error: str) -> None:
+        """
+        Ask the LLM to fix the current response. In a side conversation, only the broken
+        function and the error are sent, and the fixed function replaces the broken one
+        in the history of the main conversation.
+
+        Args:
+            error (str): the validation error
+        """
+        self.generation["repairs"] += 1
+        broken = self.response
+        if not self.side_repair:
+            self.llm.add_message(error)
+            self.response = self._timed_generation(self.llm)
+            return
+        chat = OllamaChat(
+            model=self.llm.model,
+            system_prompt=REPAIR_SYSTEM_PROMPT,
+            options=self.llm.options.copy(),
+            keep_alive=self.llm.keep_alive,
+            request_limiter=self.llm.request_limiter,
+            stop_after_code=self.llm.stop_after_code,
+            response_format=self.llm.response_format,
+        )
+        chat.session = self.llm.session
+        chat.timeout = self.llm.timeout
+        chat.add_message(f"```python\n{broken}\n```\nError: {error}")
+        self.response = self._timed_generation(chat)
+        self._replace_in_history(broken, self.response)
+
+    def resample(self, sample: int) -> None:
+        """
+        Roll back the main conversation to the prompt of the current sample, without the failed
+        response and its repair turns, and sample a new response with another seed
+
+        Args:
+            sample (int): the number of the sample, added to the seed
+        """
+        self.generation["samples"] += 1
+        del self.llm.messages[self.history_length:] # the errors and the repairs, only there without side_repair
+        if self.sample_message is not None:
+            self.llm.messages.pop(self.sample_message)
+        seed = self.llm.options.get("seed", 0) + 1000 * sample # away from the seeds of generate_responses
+        self.response = self._timed_generation(self.llm, {"seed": seed})
+        self._start_sample()
+
+    def _start_sample(self) -> None:
+        """
+        Locate the response of a new sample in the main conversation, the repair turns
+        are added after and rolled back by resample
+        """
+        self.history_length = len(self.llm.messages)
+        self.sample_message = self._find_in_history(self.response)
+
+    def _timed_generation(self, chat: OllamaChat, llm_options: dict = {}) -> str:
+        """
+        Generate a response and record its cost in the generation statistics
+
+        Args:
+            chat (OllamaChat): the conversation
+            llm_options (dict, optional): Temporary generation options. Defaults to {}.
 
-        return reward_func
+        Returns:
+            str: the response
+        """
+        start = perf_counter()
+        response = chat.generate_response(stream=True, llm_options=llm_options)
+        response = chat.print_Generator_and_return(response)
+        self.generation["latency"] += perf_counter() - start
+        self.generation["prompt_tokens"] += chat.prompt_tokens
+        return response
+
+    def _replace_in_history(self, old: str, new: str = None) -> None:
+        """
+        Replace the last assistant message of the main conversation holding a response
+
+        Args:
+            old (str): the response, raw or cleaned
+            new (str, optional): the new content, None to remove the message. Defaults to None.
+        """
+        i = self._find_in_history(old)
+        if i is None:
+            return
+        if new is None:
+            self.llm.messages.pop(i)
+        else:
+            self.llm.messages[i]["content"] = new
+
+    def _find_in_history(self, old: str) -> int:
+        """
+        Find the last assistant message of the main conversation holding a response
+
+        Args:
+            old (str): the response, raw or cleaned
+
+        Returns:
+            int: the index of the message, None if no message holds the response
+        """
+        for i in range(len(self.llm.messages) - 1, -1, -1):
+            message = self.llm.messages[i]
+            if message["role"] == "assistant" and old in message["content"]:
+                return i
+        return None
+
+    def get_probe_observations(self) -> np.ndarray:
+        """
+        Get the observations of a random run in the environment, collected once per env type
+
+        Returns:
+            np.ndarray: the observations, shape (nb_fuzz_steps, *obs_shape)
+        """
+        if self.env_name not in GenCode._probe_observations:
+            if self.env_name not in GenCode._validation_envs:
+                GenCode._validation_envs[self.env_name] = make_vec_env(self.env_name)
+            env = GenCode._validation_envs[self.env_name]
+            observations = [env.reset()[0]]
+            for _ in range(self.nb_fuzz_steps - 1):
+                obs, _, _, _ = env.step([env.action_space.sample()]) # reset by the VecEnv at the end of an episode
+                observations.append(obs[0])
+            GenCode._probe_observations[self.env_name] = np.array(observations)
+        return GenCode._probe_observations[self.env_name]
+
+    def get_step_arguments(self) -> list[tuple]:
+        """
+        Get the arguments of the reward function with the types it gets in the training
+        and in the trajectory dataset, from one step of the environment: the observation
+        with the int flags of a running step, with the flags of success_func, and in float32
+        with numpy bool flags. Computed once per env type.
+
+        Returns:
+            list[tuple]: the positional arguments of each call
+        """
+        if self.env_name not in GenCode._step_arguments:
+            env = make(self.env_name)
+            env.reset(seed=0)
+            obs, _, term, trunc, info = env.step(env.action_space.sample())
+            info["TimeLimit.truncated"] = trunc
+            info["terminated"] = term
+            info["obs"] = obs
+            try:
+                is_success, is_failure = self.success_func(env, info)
+            except Exception: # the success function may expect the end of an episode
+                is_success, is_failure = False, False
+            env.close()
+            GenCode._step_arguments[self.env_name] = [
+                (obs, 0, 0),
+                (obs, is_success, is_failure),
+                (np.asarray(obs, dtype=np.float32), np.bool_(is_success), np.bool_(is_failure)),
+            ]
+        return GenCode._step_arguments[self.env_name]
+
+    def run_probe(self, calls: list[tuple]) -> tuple[list, list[float]]:
+        """
+        Call the function of the cleaned response with each arguments,
+        in the sandbox if available
+
+        Args:
+            calls (list[tuple]): the positional arguments of each call
+
+        Raises:
+            RuntimeError: if a call fails, hangs or exhausts the memory
+
+        Returns:
+            tuple[list, list[float]]: the output and the duration of each call
+        """
+        if self.sandbox is not None:
+            # a hanging or exploding function only kills the sandbox
+            return self.sandbox.run(self.response, calls)
+        reward_func = self.compile_reward_function()
+        outputs, timings = [], []
+        try:
+            for args in calls:
+                start = perf_counter()
+                outputs.append(reward_func(*args))
+                timings.append(perf_counter() - start)
+        except Exception as e:
+            raise RuntimeError(f"Error during reward function execution: {e}")
+        return outputs, timings
+
+    def check_outputs(self, calls: list[tuple], outputs: list, timings: list[float]) -> None:
+        """
+        Check that the probe calls return finite scalar floats fast enough
+
+        Args:
+            calls (list[tuple]): the positional arguments of each call
+            outputs (list): the output of each call
+            timings (list[float]): the duration of each call in seconds
+
+        Raises:
+            ValueError: if an output is not a finite scalar or the function is too slow
+        """
+        for (_, is_success, is_failure), output in zip(calls, outputs):
+            if np.ndim(output) != 0 or not np.issubdtype(np.asarray(output).dtype, np.number):
+                raise ValueError(
+                    f"The reward function must return a scalar float, it returned {output!r} "
+                    f"(is_success={bool(is_success)}, is_failure={bool(is_failure)})."
+                )
+            if not np.isfinite(output):
+                raise ValueError(
+                    f"The reward function returned {output} (is_success={bool(is_success)}, "
+                    f"is_failure={bool(is_failure)}), it must always return a finite float."
+                )
+        latency = float(np.mean(timings))
+        self.logger.debug(f"reward function latency: {latency * 1e6:.1f}us per call")
+        if latency > self.max_latency:
+            raise ValueError(
+                f"The reward function is too slow: {latency * 1e6:.0f}us per call, "
+                f"the maximum is {self.max_latency * 1e6:.0f}us. Avoid loops and allocations in the function."
+            )
+
+    def get_cached_function(self) -> Callable:
+        """
+        Look for the cleaned response in the code cache
+
+        Raises:
+            RuntimeError: if the same function has already failed the validation
+
+        Returns:
+            Callable: the compiled reward function, None if the function is unknown
+        """
+        if self.code_cache is None:
+            return None
+        self.key = self.code_cache.key(self.response)
+        entry = self.code_cache.get(self.key)
+        if entry is None:
+            return None
+        self.logger.info(f"code cache hit {self.key[:8]}, valid: {entry['valid']}")
+        if not entry["valid"]:
+            self.key = None # already recorded
+            raise RuntimeError(entry["error"])
+        if self.key not in self.code_cache.compiled:
+            self.code_cache.compiled[self.key] = self.compile_reward_function()
+        return self.code_cache.compiled[self.key]
+
+    def cache_validation(self, error: str = None, reward_func: Callable = None) -> None:
+        """
+        Record the validation result of the cleaned response in the code cache
+
+        Args:
+            error (str, optional): the validation error, None if valid. Defaults to None.
+            reward_func (Callable, optional): the compiled reward function if valid. Defaults to None.
+        """
+        if self.code_cache is None or self.key is None:
+            return
+        self.code_cache.set_validation(self.key, self.response, error is None, error)
+        if reward_func is not None:
+            self.code_cache.compiled[self.key] = reward_func
 
     def get_clean_response(self) -> None:
         """
@@ -129,6 +564,9 @@ class GenCode:
         Logging:
             Logs the cleaned code at DEBUG level for debugging purposes.
         """
+        if self.structured:
+            self.parse_structured_response()
+            return
         start_idx = self.response.find("```")
         end_idx = self.response.find("```", start_idx + 1)
         if "def " not in self.response:
@@ -145,6 +583,38 @@ class GenCode:
         # self.logger.debug("Code nettoyé pour compilation :\n" + cleaned_response)
         self.response = cleaned_response
 
+    def parse_structured_response(self) -> None:
+        """
+        Get the code of a structured response and check its signature, only the imports
+        and the reward function are kept. The code replaces the JSON in the history.
+
+        Raises:
+            ValueError: if the response is not a JSON object with a "code" field,
+                or if the code does not define exactly one function with the expected signature
+            SyntaxError: if the code is not valid python
+        """
+        raw = self.response
+        try:
+            code = json.loads(raw)["code"]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            raise ValueError('The answer must be a JSON object with the code of the function in the "code" field.')
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            raise SyntaxError(f"Syntax error in the generated code : {e}")
+        functions = [node for node in tree.body if isinstance(node, ast.FunctionDef)]
+        if len(functions) != 1:
+            raise ValueError(f"The code must define exactly one function, it defines {len(functions)}.")
+        args = [arg.arg for arg in functions[0].args.args]
+        if functions[0].name != REWARD_FUNCTION_NAME or args != REWARD_FUNCTION_ARGS:
+            raise ValueError(
+                f"The function must be {REWARD_FUNCTION_NAME}({', '.join(REWARD_FUNCTION_ARGS)}), "
+                f"not {functions[0].name}({', '.join(args)})."
+            )
+        kept = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef))]
+        self.response = "\n".join(ast.get_source_segment(code, node) for node in kept)
+        self._replace_in_history(raw, self.response)
+
     def compile_reward_function(self) -> Callable:
         """
         Compile a reward function dynamically from a string response.
@@ -1,12 +1,22 @@
 import base64
+import codeop
 import json
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
+from time import perf_counter
 from typing import Dict, Generator, Optional, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 OLLAMA_CHAT_API_URL = "http://localhost:11434/api/chat"
 OLLAMA_API_URL = "http://localhost:11434/api/generate"
+CHARS_PER_TOKEN = 4 # rough estimate of the tokenizers on code and english
+MESSAGE_TOKENS = 4 # role and template tokens around each message
+CODE_LINE_STARTS = ("def ", "async def ", "@", "import ", "from ", "class ", "#", ")", "]", "}")
+BLOCK_CONTINUATIONS = ("else:", "elif ", "except", "finally:") # not valid python on their own
 
 
 class OllamaChat:
@@ -18,7 +28,16 @@ class OllamaChat:
         model: str = "qwen2.5-coder",
         system_prompt: Optional[str] = None,
         options: Optional[Dict] = None,
-        proxies: dict = None
+        proxies: dict = None,
+        token_budget: int = None,
+        keep_alive: str = "30m",
+        request_limiter=None,
+        stop_after_code: bool = False,
+        response_format: Union[str, Dict] = None,
+        timeout: float = 600.0,
+        connect_timeout: float = 10.0,
+        retries: int = 3,
+        backoff: float = 1.0,
     ) -> None:
         """
         Initialize an advanced Ollama chat session with extended configuration.
@@ -28,24 +47,62 @@ class OllamaChat:
             system_prompt (str, optional): Initial system message to set chat context.
             options (dict, optional): Advanced model generation parameters.
             proxies (dict, optional): Proxy configuration for the HTTP requests.
+            token_budget (int, optional): Maximum number of prompt tokens sent, the oldest turns
+                beyond are dropped. Defaults to num_ctx - num_predict of the options, None to keep all.
+            keep_alive (str, optional): How long the server keeps the model and its prompt cache loaded
+                after a request. Defaults to "30m".
+            request_limiter (Semaphore, optional): Semaphore shared by the chats of several
+                processes to bound their concurrent requests. Defaults to None.
+            stop_after_code (bool, optional): Close a streamed response as soon as the first code block
+                is complete, the server stops generating the explanations. Defaults to False.
+            response_format (str | dict, optional): Structured output of the responses, "json" or a JSON
+                schema the server constrains the generation to. Defaults to None.
+            timeout (float, optional): Maximum time between two chunks of a response in seconds. Defaults to 600.0.
+            connect_timeout (float, optional): Maximum time to open a connection in seconds. Defaults to 10.0.
+            retries (int, optional): Number of retries of a request on connection errors and server errors. Defaults to 3.
+            backoff (float, optional): Delay before the first retry in seconds, doubled at each retry. Defaults to 1.0.
         """
         self.proxies = proxies
+        self.session = requests.Session() # keep-alive connection reused by every request
+        retry = Retry(
+            total=retries, backoff_factor=backoff, status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset(["POST"]), raise_on_status=False,
+        )
+        self.session.mount("http://", HTTPAdapter(max_retries=retry))
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+        self.timeout = (connect_timeout, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        if proxies:
+            self.session.proxies.update(proxies)
         self.model = model
         self.messages: list[Dict[str, str]] = []
         self.options = options or {}
         self.logger = getLogger("VIRAL")
+        if token_budget is None and "num_ctx" in self.options:
+            token_budget = self.options["num_ctx"] - max(0, self.options.get("num_predict", 0))
+        self.token_budget = token_budget
+        self.prompt_tokens: int = 0 # estimated size of the last prompt
+        self.prompt_eval_count: int = None # size of the last prompt evaluated by the server
+        self.keep_alive = keep_alive
+        self.ttft: float = None # time to first token of the last streamed response
+        self.request_limiter = request_limiter
+        self.stop_after_code = stop_after_code
+        self.generation_time: float = None # duration of the last streamed response
+        self.response_format = response_format
 
         if system_prompt:
             self.logger.info(f"System: {system_prompt}, Options: {self.options}")
             self.add_message(system_prompt, role="system")
 
-    def add_message(self, content: str, role: str = "user", **kwargs) -> None:
+    def add_message(self, content: str, role: str = "user", pinned: bool = False, **kwargs) -> None:
         """
         Add a message to the chat history with optional metadata.
 
         Args:
             content (str): The message content
             role (str, optional): Message role (user/assistant/system)
+            pinned (bool, optional): Never drop the message from the context, as the system prompt
             kwargs (dict): Additional message metadata
         """
         if 'images' in kwargs.keys():
@@ -55,8 +112,81 @@ class OllamaChat:
                     imgs_encoded.append(base64.b64encode(image_file.read()).decode('utf-8'))
             kwargs['images'] = imgs_encoded
         message = {"role": role, "content": content, **kwargs}
+        if pinned:
+            message["pinned"] = True
         self.messages.append(message)
 
+    @staticmethod
+    def estimate_tokens(message: dict) -> int:
+        """
+        Estimate the number of tokens of a message
+
+        Args:
+            message (dict): a message of the history
+
+        Returns:
+            int: the estimated number of tokens
+        """
+        return MESSAGE_TOKENS + len(message["content"]) // CHARS_PER_TOKEN
+
+    def get_context(self) -> list[Dict[str, str]]:
+        """
+        Get the messages to send within the token budget: the system prompt, the pinned messages
+        and the latest turns. The dropped turns are replaced by a placeholder.
+
+        Returns:
+            list[dict]: the messages of the request
+        """
+        messages = [{key: value for key, value in message.items() if key != "pinned"} for message in self.messages]
+        sizes = [self.estimate_tokens(message) for message in messages]
+        kept = [message["role"] == "system" or message.get("pinned", False) for message in self.messages]
+        if messages:
+            kept[-1] = True # the prompt of the request
+        if self.token_budget is None:
+            kept = [True] * len(messages)
+        total = sum(size for size, keep in zip(sizes, kept) if keep)
+        for i in range(len(messages) - 1, -1, -1):
+            if not kept[i] and total + sizes[i] <= self.token_budget:
+                kept[i] = True
+                total += sizes[i]
+            elif not kept[i]:
+                break # keep a contiguous tail of turns
+
+        context = []
+        nb_dropped = 0
+        for message, keep in zip(messages, kept):
+            if keep:
+                if nb_dropped > 0:
+                    context.append({"role": "user", "content": f"[{nb_dropped} earlier messages omitted]"})
+                    nb_dropped = 0
+                context.append(message)
+            else:
+                nb_dropped += 1
+        self.prompt_tokens = sum(self.estimate_tokens(message) for message in context)
+        if not all(kept):
+            self.logger.debug(f"context: {sum(not keep for keep in kept)} messages dropped to fit {self.token_budget} tokens")
+        return context
+
+    def _strip_images(self) -> None:
+        """
+        Remove the images of the history once they have been sent, the model has already described them
+        """
+        for message in self.messages:
+            if message.pop("images", None) is not None:
+                message["content"] += "\n[image sent earlier]"
+
+    def _log_prompt_tokens(self, prompt_eval_count: int = None) -> None:
+        """
+        Report the size of the last prompt
+
+        Args:
+            prompt_eval_count (int, optional): the number of prompt tokens evaluated by the server. Defaults to None.
+        """
+        self.prompt_eval_count = prompt_eval_count
+        self.logger.debug(
+            f"prompt tokens: {self.prompt_tokens} estimated, {prompt_eval_count} evaluated, budget {self.token_budget}"
+        )
+
     def generate_response(
         self, stream: bool = False, llm_options: Optional[Dict] = {}
     ) -> Union[str, Generator]:
@@ -74,44 +204,309 @@ class OllamaChat:
 
         payload = {
             "model": self.model,
-            "messages": self.messages,
+            "messages": self.get_context(),
             "stream": stream,
             "options": generation_options,
+            "keep_alive": self.keep_alive,
         }
+        if self.response_format is not None:
+            payload["format"] = self.response_format
 
+        streaming = False
+        self._acquire()
         try:
-            if self.proxies:
-                response = requests.post(OLLAMA_CHAT_API_URL, json=payload, stream=stream, proxies=self.proxies)
-            else:
-                response = requests.post(OLLAMA_CHAT_API_URL, json=payload, stream=stream)
+            start = perf_counter()
+            response = self.session.post(OLLAMA_CHAT_API_URL, json=payload, stream=stream, timeout=self.timeout)
             response.raise_for_status()
+            self._strip_images()
             if not stream:
                 full_response = response.json()
+                self._log_prompt_tokens(full_response.get("prompt_eval_count"))
                 assistant_response = full_response.get("message", {}).get("content", "")
                 self.add_message(assistant_response, role="assistant")
                 return assistant_response
 
             def stream_response():
-                full_response = ""
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            json_response = json.loads(line.decode("utf-8"))
-                            if "message" in json_response:
-                                chunk = json_response["message"].get("content", "")
-                                full_response += chunk
-                                yield chunk
-                        except json.JSONDecodeError:
-                            continue
-
-                if full_response:
-                    self.add_message(full_response, role="assistant")
-
+                stream = self._new_stream(start)
+                try:
+                    for line in response.iter_lines():
+                        if line:
+                            text, stop = self._read_stream_line(line.decode("utf-8"), stream)
+                            if text:
+                                yield text
+                            if stop:
+                                break
+                    if self._held_back(stream):
+                        yield self._held_back(stream)
+                finally:
+                    response.close() # on an early stop, the server stops generating
+                    self._release() # the generation slot is held until the end of the stream
+                self._end_stream(stream)
+
+            streaming = True
             return stream_response()
 
         except requests.exceptions.RequestException as e:
             self.logger.error(f"Connection error: {e}")
             return ""
+        finally:
+            if not streaming:
+                self._release()
+
+    @staticmethod
+    def _new_stream(start: float) -> dict:
+        """
+        Get the state of a new streamed response
+
+        Args:
+            start (float): the time the request was sent
+
+        Returns:
+            dict: the start time, the response received so far, the length already given
+                (with stop_after_code, only the complete lines are given) and the early stop flag
+        """
+        return {"start": start, "response": "", "emitted": 0, "stopped": False}
+
+    def _read_stream_line(self, line: str, stream: dict) -> tuple[str, bool]:
+        """
+        Read a JSON line of a streamed response, with stop_after_code the response
+        is cut after its first code
+
+        Args:
+            line (str): the line
+            stream (dict): the state of the response, see _new_stream
+
+        Returns:
+            tuple[str, bool]: the text to give, True if the rest of the response is not needed
+        """
+        try:
+            json_response = json.loads(line)
+        except json.JSONDecodeError:
+            return "", False
+        text = ""
+        if "message" in json_response:
+            chunk = json_response["message"].get("content", "")
+            if stream["response"] == "" and chunk != "":
+                self.ttft = perf_counter() - stream["start"]
+            stream["response"] += chunk
+            if not self.stop_after_code:
+                text = chunk
+            elif "\n" in chunk or "`" in chunk:
+                end = self.code_end(stream["response"])
+                if end != -1:
+                    stream["response"] = stream["response"][:end]
+                    stream["stopped"] = True
+                    return "", True
+                complete = stream["response"].rfind("\n") + 1
+                if complete > stream["emitted"]:
+                    text = stream["response"][stream["emitted"]:complete]
+                    stream["emitted"] = complete
+        if json_response.get("done", False):
+            if stream["response"] == "":
+                self.ttft = perf_counter() - stream["start"]
+            self._log_prompt_tokens(json_response.get("prompt_eval_count"))
+            self.logger.debug(f"time to first token: {self.ttft:.2f}s")
+        return text, False
+
+    def _held_back(self, stream: dict) -> str:
+        """
+        Get the end of a streamed response held back by stop_after_code
+
+        Args:
+            stream (dict): the state of the response, see _new_stream
+
+        Returns:
+            str: the text not given yet
+        """
+        if not self.stop_after_code:
+            return ""
+        return stream["response"][stream["emitted"]:]
+
+    def _end_stream(self, stream: dict) -> None:
+        """
+        Record the duration of a streamed response and add it to the history
+
+        Args:
+            stream (dict): the state of the response, see _new_stream
+        """
+        self.generation_time = perf_counter() - stream["start"]
+        self.logger.debug(
+            f"generation time: {self.generation_time:.2f}s, stopped after the code: {stream['stopped']}"
+        )
+        if stream["response"]:
+            self.add_message(stream["response"], role="assistant")
+
+    @staticmethod
+    def code_end(text: str, function_name: str = "reward_func") -> int:
+        """
+        Find the end of the first code of a partial response: the closing fence of the first
+        code block, or without fences, after a complete function the first unindented line
+        which is not python. After the body of function_name, only the definitions, the imports
+        and the comments are kept.
+
+        Args:
+            text (str): the response received so far
+            function_name (str, optional): the function asked for. Defaults to "reward_func".
+
+        Returns:
+            int: the position after the code, -1 if the code is not complete yet
+        """
+        start = text.find("```")
+        if start != -1:
+            end = text.find("```", start + 3)
+            return -1 if end == -1 else end + 3
+        position = 0
+        in_def = False
+        has_body = False
+        in_function = False # the current function is function_name
+        function_done = False
+        depth, quote = 0, None # open brackets and open triple quoted string
+        for line in text.split("\n")[:-1]: # the last line may be incomplete
+            if depth == 0 and quote is None and line.strip() != "":
+                if line[0].isspace():
+                    has_body = has_body or in_def
+                elif in_def and has_body:
+                    function_done = function_done or in_function
+                    if function_done and not line.startswith(CODE_LINE_STARTS):
+                        return position
+                    if not OllamaChat._is_python(line):
+                        return position
+                if line.startswith(("def ", "async def ")):
+                    in_def = True
+                    has_body = False
+                    in_function = line.split("def ", 1)[1].startswith(f"{function_name}(")
+            depth, quote = OllamaChat._scan_line(line, depth, quote)
+            position += len(line) + 1
+        return -1
+
+    @staticmethod
+    def _is_python(line: str) -> bool:
+        """
+        Check if an unindented line starts a python statement, complete or not
+
+        Args:
+            line (str): the line
+
+        Returns:
+            bool: False if the line is not python, for instance an explanation
+        """
+        if line.startswith(BLOCK_CONTINUATIONS):
+            return True
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore") # invalid escapes of the text
+                codeop.compile_command(line, symbol="exec")
+        except (SyntaxError, ValueError, OverflowError):
+            return False
+        return True
+
+    @staticmethod
+    def _scan_line(line: str, depth: int, quote: str = None) -> tuple[int, str]:
+        """
+        Follow the brackets and the triple quoted strings of a line of code,
+        the comments and the brackets in strings are ignored
+
+        Args:
+            line (str): the line of code
+            depth (int): the number of open brackets before the line
+            quote (str, optional): the triple quote open before the line. Defaults to None.
+
+        Returns:
+            tuple[int, str]: the number of open brackets and the triple quote open after the line
+        """
+        i = 0
+        while i < len(line):
+            if quote is not None:
+                if line[i] == "\\":
+                    i += 2
+                    continue
+                if line.startswith(quote, i):
+                    i += len(quote)
+                    quote = None
+                    continue
+            elif line[i] == "#":
+                break
+            elif line.startswith(('"""', "'''"), i):
+                quote = line[i:i + 3]
+                i += 3
+                continue
+            elif line[i] in "\"'":
+                quote = line[i]
+            elif line[i] in "([{":
+                depth += 1
+            elif line[i] in ")]}":
+                depth = max(0, depth - 1)
+            i += 1
+        if quote in ('"', "'"): # a simple string does not span lines
+            quote = None
+        return depth, quote
+
+    def _acquire(self) -> None:
+        """
+        Wait for a free request slot if the requests are bounded
+        """
+        if self.request_limiter is not None:
+            self.request_limiter.acquire()
+
+    def _release(self) -> None:
+        """
+        Free the request slot
+        """
+        if self.request_limiter is not None:
+            self.request_limiter.release()
+
+    def generate_responses(
+        self, k: int, llm_options: Optional[Dict] = {}, max_workers: int = None
+    ) -> list[str]:
+        """
+        Generate k independent responses to the same history with concurrent requests.
+        Each request has its own seed, the common prefix is evaluated once by the server
+        if it runs with OLLAMA_NUM_PARALLEL >= k. The responses are not added to the history,
+        each one is an alternative reply to the last message.
+
+        Args:
+            k (int): the number of responses
+            llm_options (dict, optional): Temporary generation options
+            max_workers (int, optional): the maximum number of concurrent requests. Defaults to k.
+
+        Returns:
+            list[str]: the k responses, an empty string for a failed request
+        """
+        generation_options = {**self.options, **(llm_options or {})}
+        seed = generation_options.get("seed", 0)
+        messages = self.get_context()
+        payloads = [
+            {
+                "model": self.model,
+                "messages": messages,
+                "stream": False,
+                "options": {**generation_options, "seed": seed + i},
+                "keep_alive": self.keep_alive,
+            }
+            for i in range(k)
+        ]
+        if self.response_format is not None:
+            for payload in payloads:
+                payload["format"] = self.response_format
+
+        def request(payload: dict) -> str:
+            self._acquire()
+            try:
+                response = self.session.post(OLLAMA_CHAT_API_URL, json=payload, timeout=self.timeout)
+                response.raise_for_status()
+                full_response = response.json()
+                self._log_prompt_tokens(full_response.get("prompt_eval_count"))
+                return full_response.get("message", {}).get("content", "")
+            except requests.exceptions.RequestException as e:
+                self.logger.error(f"Connection error (seed {payload['options']['seed']}): {e}")
+                return ""
+            finally:
+                self._release()
+
+        with ThreadPoolExecutor(max_workers=max_workers or k) as executor:
+            responses = list(executor.map(request, payloads))
+        self._strip_images()
+        return responses
 
     def generate_simple_response(
         self,
@@ -140,13 +535,13 @@ class OllamaChat:
             "system": sys_prompt,
             "stream": stream,
             "options": generation_options,
+            "keep_alive": self.keep_alive,
         }
 
+        streaming = False
+        self._acquire()
         try:
-            if self.proxies:
-                response = requests.post(OLLAMA_CHAT_API_URL, json=payload, stream=stream, proxies=self.proxies)
-            else:
-                response = requests.post(OLLAMA_CHAT_API_URL, json=payload, stream=stream)
+            response = self.session.post(OLLAMA_CHAT_API_URL, json=payload, stream=stream, timeout=self.timeout)
             response.raise_for_status()
             if not stream:
                 full_response = response.json()
@@ -156,25 +551,32 @@ class OllamaChat:
 
             def stream_response():
                 full_response = ""
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            json_response = json.loads(line.decode("utf-8"))
-                            if "response" in json_response:
-                                chunk = json_response["response"]
-                                full_response += chunk
-                                yield chunk
-                        except json.JSONDecodeError:
-                            continue
+                try:
+                    for line in response.iter_lines():
+                        if line:
+                            try:
+                                json_response = json.loads(line.decode("utf-8"))
+                                if "response" in json_response:
+                                    chunk = json_response["response"]
+                                    full_response += chunk
+                                    yield chunk
+                            except json.JSONDecodeError:
+                                continue
+                finally:
+                    self._release()
 
                 if full_response:
                     self.add_message(full_response, role="assistant")
 
+            streaming = True
             return stream_response()
 
         except requests.exceptions.RequestException as e:
             self.logger.error(f"Connection error: {e}")
             return ""
+        finally:
+            if not streaming:
+                self._release()
 
     def print_Generator_and_return(
         self, response: Generator | str, number: int = 1
@@ -0,0 +1,224 @@
+import multiprocessing
+import os
+import resource
+import signal
+from logging import getLogger
+from multiprocessing.connection import Connection
+from time import perf_counter
+from typing import Any, Callable
+
+import numpy as np
+
+
+class SandboxError(RuntimeError):
+    """
+    Failure of a generated code in the sandbox
+
+    Attributes:
+        kind (str): "timeout", "memory", "syntax" or "exception"
+    """
+    def __init__(self, kind: str, message: str):
+        """
+        Initialize the error
+
+        Args:
+            kind (str): the kind of failure
+            message (str): the message for the LLM
+        """
+        super().__init__(message)
+        self.kind = kind
+
+
+def _virtual_memory_size() -> int:
+    """
+    Get the virtual memory size of the current process
+
+    Returns:
+        int: the size in bytes, 0 if unknown
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmSize:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _limit_resources(cpu_time: int, memory: int) -> None:
+    """
+    Limit the CPU time and the memory of the current process
+
+    Args:
+        cpu_time (int): the CPU time limit in seconds
+        memory (int): the memory allowed on top of the current process, in bytes
+    """
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 1))
+    vm_size = _virtual_memory_size()
+    if vm_size > 0:
+        resource.setrlimit(resource.RLIMIT_AS, (vm_size + memory, vm_size + memory))
+
+
+def _sandbox_worker(source: str, calls: list[tuple], cpu_time: int, memory: int, conn: Connection) -> None:
+    """
+    Entry point of the sandbox, limit the resources then define and call the function
+
+    Args:
+        source (str): the source of the function
+        calls (list[tuple]): the positional arguments of each call
+        cpu_time (int): the CPU time limit in seconds
+        memory (int): the memory allowed on top of the forked process, in bytes
+        conn (Connection): the pipe to send (kind, outputs or message, timings)
+    """
+    _limit_resources(cpu_time, memory)
+    try:
+        exec_globals = {"np": np}
+        try:
+            exec(source, exec_globals)
+        except SyntaxError as e:
+            conn.send(("syntax", str(e), []))
+            return
+        function = exec_globals.get(source.split("(")[0].split()[-1])
+        outputs, timings = [], []
+        for args in calls:
+            start = perf_counter()
+            outputs.append(function(*args))
+            timings.append(perf_counter() - start)
+        conn.send(("ok", outputs, timings))
+    except MemoryError:
+        conn.send(("memory", "MemoryError", []))
+    except Exception as e:
+        conn.send(("exception", f"{type(e).__name__}: {e}", []))
+    finally:
+        conn.close()
+
+
+def _call_worker(function: Callable, args: tuple, cpu_time: int, memory: int, conn: Connection) -> None:
+    """
+    Entry point of the sandbox of a function already defined, limit the resources then call it
+
+    Args:
+        function (Callable): the function, inherited by the fork
+        args (tuple): the positional arguments of the call
+        cpu_time (int): the CPU time limit in seconds
+        memory (int): the memory allowed on top of the forked process, in bytes
+        conn (Connection): the pipe to send (kind, output or message, timings)
+    """
+    _limit_resources(cpu_time, memory)
+    try:
+        start = perf_counter()
+        output = function(*args)
+        conn.send(("ok", output, [perf_counter() - start]))
+    except MemoryError:
+        conn.send(("memory", "MemoryError", []))
+    except Exception as e:
+        conn.send(("exception", f"{type(e).__name__}: {e}", []))
+    finally:
+        conn.close()
+
+
+class Sandbox:
+    """
+    Run a generated function in a forked process with CPU time and memory limits
+    and a wall-clock deadline, so an infinite loop or a huge allocation only kills the sandbox
+    """
+    def __init__(self, timeout: float = 5.0, cpu_time: int = 5, memory_mb: int = 512):
+        """
+        Initialize the sandbox
+
+        Args:
+            timeout (float, optional): wall-clock deadline of all the calls in seconds. Defaults to 5.0.
+            cpu_time (int, optional): CPU time limit in seconds. Defaults to 5.
+            memory_mb (int, optional): memory allowed on top of the forked process in MB. Defaults to 512.
+        """
+        assert (os.name == "posix"), "multi-proccess features only available on LINUX system..."
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.memory = memory_mb * 1024 * 1024
+        self.logger = getLogger("VIRAL")
+        self.context = multiprocessing.get_context("fork")
+
+    def run(self, source: str, calls: list[tuple]) -> tuple[list, list[float]]:
+        """
+        Define the function of the source and call it with each arguments
+
+        Args:
+            source (str): the source of the function
+            calls (list[tuple]): the positional arguments of each call
+
+        Raises:
+            SandboxError: the kind of failure and a message for the LLM
+
+        Returns:
+            tuple[list, list[float]]: the output and the duration of each call
+        """
+        return self._start(_sandbox_worker, (source, calls))
+
+    def call(self, function: Callable, *args) -> Any:
+        """
+        Call a function already defined in this process, for instance a compiled reward
+        function on a large input. The function is inherited by the fork, not pickled.
+
+        Args:
+            function (Callable): the function
+            args: the positional arguments of the call, inherited by the fork
+
+        Raises:
+            SandboxError: the kind of failure and a message for the LLM
+
+        Returns:
+            Any: the output of the call, pickled back
+        """
+        output, _ = self._start(_call_worker, (function, args))
+        return output
+
+    def _start(self, worker: Callable, args: tuple) -> tuple[Any, list[float]]:
+        """
+        Run a sandbox worker in a forked process and wait for its result within the limits
+
+        Args:
+            worker (Callable): the entry point of the sandbox
+            args (tuple): the arguments of the worker before the limits and the pipe
+
+        Raises:
+            SandboxError: the kind of failure and a message for the LLM
+
+        Returns:
+            tuple[Any, list[float]]: the result and the timings sent by the worker
+        """
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=worker, args=(*args, self.cpu_time, self.memory, writer)
+        )
+        process.start()
+        writer.close()
+        try:
+            if not reader.poll(self.timeout):
+                process.kill()
+                raise SandboxError(
+                    "timeout", f"Timeout: the reward function did not return within {self.timeout}s, check for infinite loops."
+                )
+            try:
+                kind, result, timings = reader.recv()
+            except EOFError:
+                process.join()
+                if process.exitcode == -signal.SIGXCPU:
+                    raise SandboxError(
+                        "timeout", f"Timeout: the reward function used more than {self.cpu_time}s of CPU time."
+                    )
+                raise SandboxError(
+                    "memory", f"Memory: the reward function was killed (exit code {process.exitcode}), check the allocations."
+                )
+        finally:
+            process.join()
+            reader.close()
+        if kind == "syntax":
+            raise SandboxError(kind, f"Syntax error in the generated code : {result}")
+        if kind == "memory":
+            raise SandboxError(
+                kind, f"Memory: the reward function exceeded {self.memory // (1024 * 1024)}MB, check the allocations."
+            )
+        if kind == "exception":
+            raise SandboxError(kind, f"Error during reward function execution: {result}")
+        return result, timings
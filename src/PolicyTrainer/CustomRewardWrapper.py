@@ -1,10 +1,11 @@
+from time import perf_counter
 from typing import Callable
 
 import gymnasium as gym
 
 
 class CustomRewardWrapper(gym.Wrapper):
-    def __init__(self, env: gym.Env, success_func: Callable = None, llm_reward_function: Callable = None):
+    def __init__(self, env: gym.Env, success_func: Callable = None, llm_reward_function: Callable = None, profile: bool = False):
         """
         Initialize the custom reward wrapper
         
@@ -12,11 +13,33 @@ class CustomRewardWrapper(gym.Wrapper):
             env (gym.Env): the current environment
             success_func (Callable, optional): this function should return True if success. Defaults to None.
             llm_reward_function (Callable, optional): the generated reward function. Defaults to None.
+            profile (bool, optional): accumulate the time spent in the env step,
+                the reward function and the success function. Defaults to False.
         
         """
         super().__init__(env)
         self.success_func = success_func
         self.llm_reward_function = llm_reward_function
+        self.profile = profile
+        self.timings = {"env_step": 0.0, "reward_func": 0.0, "success_func": 0.0}
+
+    def _call(self, key: str, func: Callable, *args):
+        """
+        Call a function, and accumulate its duration in timings if profiling
+
+        Args:
+            key (str): the key of the duration in timings
+            func (Callable): the function to call
+
+        Returns:
+            the result of the function
+        """
+        if not self.profile:
+            return func(*args)
+        start = perf_counter()
+        result = func(*args)
+        self.timings[key] += perf_counter() - start
+        return result
 
     def step(self, action):
         """
@@ -32,18 +55,22 @@ class CustomRewardWrapper(gym.Wrapper):
             truncated (): True if the episode is truncated
             info (): additional information
         """
-        observation, original_reward, terminated, truncated, info = self.env.step(
-            action
+        observation, original_reward, terminated, truncated, info = self._call(
+            "env_step", self.env.step, action
         )
-        if self.llm_reward_function is not None and self.success_func is not None:
+        info["original_reward"] = original_reward
+        if self.success_func is not None:
             info['TimeLimit.truncated'] = truncated
             info['terminated'] = terminated
             info["obs"] = observation
             is_success = 0
             is_failure = 0
             if terminated or truncated:
-                is_success, is_failure = self.success_func(self.env, info)
-            reward = self.llm_reward_function(observation, is_success, is_failure)
+                is_success, is_failure = self._call("success_func", self.success_func, self.env, info)
+                info["is_success"] = is_success
+                info["is_failure"] = is_failure
+        if self.llm_reward_function is not None and self.success_func is not None:
+            reward = self._call("reward_func", self.llm_reward_function, observation, is_success, is_failure)
         else:
             reward = original_reward
             #print(f"Observation: {observation}")
@@ -0,0 +1,98 @@
+from logging import getLogger
+from typing import Callable
+
+from stable_baselines3.common.base_class import BaseAlgorithm
+from stable_baselines3.common.callbacks import BaseCallback
+
+logger = getLogger("VIRAL")
+
+
+class EarlyStoppingCallback(BaseCallback):
+    def __init__(
+        self,
+        evaluate: Callable[[BaseAlgorithm], float],
+        eval_freq: int,
+        min_sr: float = 0.0,
+        min_evals: int = 3,
+        patience: int = None,
+        min_delta: float = 0.0,
+    ):
+        """
+        Callback for stopping the training of a hopeless reward function
+
+        Args:
+            evaluate (Callable[[BaseAlgorithm], float]): give the success rate of the model in training
+            eval_freq (int): the number of timesteps between two evaluations
+            min_sr (float, optional): stop if the best success rate is still under or equal
+                after min_evals evaluations. Defaults to 0.0.
+            min_evals (int, optional): the number of evaluations before the min_sr rule applies. Defaults to 3.
+            patience (int, optional): stop if the best success rate has not improved
+                during patience evaluations, None to disable. Defaults to None.
+            min_delta (float, optional): the minimal gain counted as an improvement. Defaults to 0.0.
+        """
+        super().__init__()
+        self.evaluate = evaluate
+        self.eval_freq = eval_freq
+        self.min_sr = min_sr
+        self.min_evals = min_evals
+        self.patience = patience
+        self.min_delta = min_delta
+        self.last_eval = 0
+        self.best_sr = -1.0
+        self.nb_no_improvement = 0
+        self.eval_history: list[float] = []
+        self.stop_reason: str = None
+
+    def _on_step(self) -> bool:
+        """
+        Call after each step of the training, evaluate the model every eval_freq timesteps
+
+        Returns:
+            bool: False to stop the training
+        """
+        if self.num_timesteps - self.last_eval < self.eval_freq:
+            return True
+        self.last_eval = self.num_timesteps
+        sr = self.evaluate(self.model)
+        self.eval_history.append(sr)
+        if sr > self.best_sr + self.min_delta:
+            self.best_sr = sr
+            self.nb_no_improvement = 0
+        else:
+            self.nb_no_improvement += 1
+
+        if len(self.eval_history) >= self.min_evals and self.best_sr <= self.min_sr:
+            self.stop_reason = "threshold"
+        elif self.patience is not None and self.nb_no_improvement >= self.patience:
+            self.stop_reason = "plateau"
+        if self.stop_reason is not None:
+            logger.info(
+                f"early stopping ({self.stop_reason}) at {self.num_timesteps} timesteps, success rates: {self.eval_history}"
+            )
+            return False
+        return True
+
+    def is_hopeless(self) -> bool:
+        """
+        Check if the training has been stopped for a reward function not worth a full test:
+        by the min_sr rule, or on a plateau still under or equal to min_sr
+
+        Returns:
+            bool: True if the last evaluation can be used as the success rate
+        """
+        return self.stop_reason == "threshold" or (self.stop_reason == "plateau" and self.best_sr <= self.min_sr)
+
+    def get_metrics(self) -> dict:
+        """
+        Get metrics harvested
+
+        Returns:
+            dict: contain the early stopping information
+        """
+        return {
+            "early_stopped": self.stop_reason is not None,
+            "hopeless": self.is_hopeless(),
+            "stop_reason": self.stop_reason,
+            "stopped_at": self.num_timesteps,
+            "eval_history": self.eval_history,
+        }
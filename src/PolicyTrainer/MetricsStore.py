@@ -0,0 +1,71 @@
+import os
+import shutil
+from logging import getLogger
+
+import numpy as np
+
+
+class MetricsStore:
+    """
+    Store the performances of a training in .npy files, so a training worker
+    only sends back a small descriptor and the parent maps the arrays without copy.
+    The files are removed as soon as they are mapped, the maps stay valid on POSIX
+    until the arrays are freed.
+    """
+    def __init__(self, directory: str = "data/metrics"):
+        """
+        Initialize the store
+
+        Args:
+            directory (str, optional): the folder of the stored metrics. Defaults to "data/metrics".
+        """
+        self.directory = directory
+        self.logger = getLogger("VIRAL")
+
+    def dump(self, metrics: dict, name: str) -> dict:
+        """
+        Write the numeric arrays of the metrics in a folder, the other values stay in the descriptor
+
+        Args:
+            metrics (dict): the performances of a training
+            name (str): the name of the folder, unique per training
+
+        Returns:
+            dict: the descriptor to give to load
+        """
+        folder = os.path.join(self.directory, name)
+        os.makedirs(folder, exist_ok=True)
+        descriptor = {"folder": folder, "arrays": [], "values": {}}
+        for key, value in metrics.items():
+            if isinstance(value, np.ndarray) and value.size > 0 and value.dtype.kind in "biuf":
+                np.save(os.path.join(folder, f"{key}.npy"), value)
+                descriptor["arrays"].append(key)
+            else:
+                descriptor["values"][key] = value
+        return descriptor
+
+    def load(self, descriptor: dict) -> dict:
+        """
+        Map the metrics written by dump and remove their folder
+
+        Args:
+            descriptor (dict): the descriptor returned by dump
+
+        Returns:
+            dict: the performances, the arrays are read-only memory maps
+        """
+        metrics = dict(descriptor["values"])
+        for key in descriptor["arrays"]:
+            metrics[key] = np.load(os.path.join(descriptor["folder"], f"{key}.npy"), mmap_mode="r")
+        self.remove(descriptor)
+        return metrics
+
+    def remove(self, descriptor: dict) -> None:
+        """
+        Delete the folder of the metrics written by dump
+
+        Args:
+            descriptor (dict): the descriptor returned by dump
+        """
+        shutil.rmtree(descriptor["folder"], ignore_errors=True)
+        self.logger.debug(f"metrics removed: {descriptor['folder']}")
@@ -1,26 +1,39 @@
 import os
+import shutil
 from logging import getLogger
-from multiprocessing import Process, Queue
-from queue import Empty
-from time import sleep
+from math import ceil
+from time import perf_counter
+from multiprocessing import Process
+from typing import Generator
 
 import gymnasium as gym
+import numpy as np
 from gymnasium import make
 from gymnasium.wrappers import RecordVideo
 from stable_baselines3 import DQN, PPO
+from stable_baselines3.common.callbacks import CallbackList
 from stable_baselines3.common.env_util import make_vec_env
+from stable_baselines3.common.vec_env import SubprocVecEnv
 from stable_baselines3.common.vec_env.base_vec_env import VecEnv
 
 from Environments.Algo import Algo
 from Environments.EnvType import EnvType
+from LLM.CodeCache import CodeCache
+from LLM.Sandbox import Sandbox, SandboxError
 from log.log_config import get_log_level
+from log.LoggerCSV import getLoggerCSV
 from PolicyTrainer.CustomRewardWrapper import CustomRewardWrapper
+from PolicyTrainer.EarlyStoppingCallback import EarlyStoppingCallback
+from PolicyTrainer.MetricsStore import MetricsStore
 from PolicyTrainer.TrainingInfoCallback import TrainingInfoCallback
+from PolicyTrainer.TrainingScheduler import SharedSlots, TrainingScheduler
+from PolicyTrainer.TrajectoryDataset import TRAJECTORY_FIELDS, TrajectoryDataset
+from PolicyTrainer.VecCustomRewardWrapper import VecCustomRewardWrapper
 from State.State import State
 
 
 class PolicyTrainer:
-    def __init__(self, memory: list[State], seed: int, env_type: EnvType, timeout: int, nb_vec_envs: int, legacy_training: bool):
+    def __init__(self, memory: list[State], seed: int, env_type: EnvType, timeout: int, nb_vec_envs: int, legacy_training: bool, max_workers: int = None, early_stopping: bool | dict = False, profile: bool = False, warm_start: bool = False, warm_start_budget: float = 0.5, code_cache: CodeCache = None, training_slots: SharedSlots = None, trajectories: TrajectoryDataset = None, prescreen_cutoff: float = 0.5, trajectory_episodes: int = 5, slow_reward_step: float = 1e-4, prescreen_timeout: float = 30.0):
         """
         Initialize the PolicyTrainer instance.
 
@@ -28,6 +41,34 @@ class PolicyTrainer:
             memory (list[State]): list of states
             env_type (EnvType): the type of environment
             timeout (int): the maximum number of timesteps
+            max_workers (int, optional): maximum number of concurrent trainings.
+                Defaults to nb_cores // nb_vec_envs.
+            early_stopping (bool | dict, optional): stop the training of the hopeless reward functions,
+                a dict gives the options of the EarlyStoppingCallback (min_sr, min_evals, patience, min_delta),
+                the number of evaluations during a training nb_evals (10) and the episodes of an evaluation
+                nb_episodes (10). Defaults to False.
+            profile (bool, optional): measure the time spent in the env steps, the reward function,
+                the success function and the gradient updates. Defaults to False.
+            warm_start (bool, optional): initialise the policy of a refined state with the weights
+                of its parent, the replay buffer of a DQN parent holds the rewards of the parent's
+                reward function and is not reused. Defaults to False.
+            warm_start_budget (float, optional): part of the timeout used to train
+                a warm started policy. Defaults to 0.5.
+            code_cache (CodeCache, optional): reuse the trainings of the reward functions
+                already trained with the same configuration, whatever the seed of the run. Defaults to None.
+            training_slots (SharedSlots, optional): the training slots shared with other runs.
+                Defaults to None (max_workers own slots).
+            trajectories (TrajectoryDataset, optional): the labelled trajectories to prescreen the reward
+                functions, the trained policies add their rollouts to it. Defaults to None (no prescreen).
+            prescreen_cutoff (float, optional): a reward function scoring under it on the trajectories
+                is not trained. Defaults to 0.5 (no better than chance).
+            trajectory_episodes (int, optional): number of rollouts of each trained policy added
+                to the trajectories. Defaults to 5.
+            slow_reward_step (float, optional): with profile, a reward function taking more seconds
+                per timestep is flagged as slow. Defaults to 1e-4 (a vectorized numpy function
+                takes a few microseconds).
+            prescreen_timeout (float, optional): the prescreen of a reward function runs in a sandbox
+                (only on LINUX), a function not scored within this time in seconds is rejected. Defaults to 30.0.
         """
         self.logger = getLogger("VIRAL")
         self.progress_bar = True if get_log_level() == "DEBUG" else False
@@ -41,74 +82,379 @@ class PolicyTrainer:
         self.objective_metric = env_type.objective_metric
         self.env_name = str(env_type)
         self.success_func = env_type.success_func
-        self.to_join: list = []
-        self.queue = Queue()
-        self.multi_process: list[Process] = []
-        self.to_get = 0
+        if os.name == "posix":
+            self.scheduler = TrainingScheduler(max_workers, nb_vec_envs, training_slots)
+            self.metrics_store = MetricsStore()
         self.legacy_training = legacy_training
+        self.early_stopping = early_stopping is not False and early_stopping is not None
+        self.early_stopping_options = early_stopping if isinstance(early_stopping, dict) else {}
+        self.profile = profile
+        self.warm_start = warm_start
+        self.warm_start_budget = warm_start_budget
+        self.slow_reward_step = slow_reward_step
+        self.code_cache = code_cache
+        self.cache_configs: dict[int, str] = {}
+        self.trajectories = trajectories
+        self.prescreen_cutoff = prescreen_cutoff
+        self.trajectory_episodes = trajectory_episodes
+        self.prescreen_sandbox = None
+        if self.trajectories is not None and os.name == "posix":
+            self.prescreen_sandbox = Sandbox(timeout=prescreen_timeout, cpu_time=ceil(prescreen_timeout), memory_mb=1024)
+        if self.trajectories is not None and len(self.trajectories) == 0:
+            self.trajectories.collect(nb_episodes=50, seed=self.seed)
         if len(self.memory) > 0 and self.legacy_training:
             self.start_learning(0)
 
-    def _learning(self, state: State, queue: Queue = None) -> None:
+    def _learning(self, state: State, timesteps: int = None) -> tuple[str, dict]:
         """
-        Train a policy for a given state
+        Train a policy for a given state, resume from its checkpoint if it has already a policy
 
         Args:
             state (State): the state to train
-            queue (Queue, optional): handle modification to return. Defaults to None.
+            timesteps (int, optional): the number of timesteps to train. Defaults to timeout.
+
+        Returns:
+            tuple[str, dict]: the path of the saved policy, the performances of the state
         """
         self.logger.info(
             f"state {state.idx} begin is learning"
         )
-        model = self._generate_env_model(state.reward_func)
+        resumable = timesteps is not None # a training with a budget may be resumed, see start_learning
+        warm_start_path = None
+        if self.warm_start and state.policy is None and state.parent is not None:
+            warm_start_path = self.memory[state.parent].policy
+        if timesteps is None:
+            timesteps = self.timeout if warm_start_path is None else int(self.timeout * self.warm_start_budget)
+        model = self._generate_env_model(state.reward_func, state.policy, warm_start_path)
         training_callback = TrainingInfoCallback()
-        policy = model.learn(total_timesteps=self.timeout, callback=training_callback, progress_bar=self.progress_bar)
+        callbacks = [training_callback]
+        if self.early_stopping:
+            options = dict(self.early_stopping_options)
+            nb_episodes = options.pop("nb_episodes", 10)
+            nb_evals = options.pop("nb_evals", 10)
+            early_stopping_callback = EarlyStoppingCallback(
+                lambda model: self.test_policy(model, nb_episodes=nb_episodes),
+                eval_freq=max(1, timesteps // nb_evals),
+                **options,
+            )
+            callbacks.append(early_stopping_callback)
+        start = perf_counter()
+        policy = model.learn(
+            total_timesteps=timesteps,
+            callback=CallbackList(callbacks),
+            progress_bar=self.progress_bar,
+            reset_num_timesteps=state.policy is None,
+        )
+        time_training = perf_counter() - start
         path = f"data/model/{self.env_name}_{self.seed}_{state.idx}.pth"
         policy.save(path)
+        if resumable and self.algo == Algo.DQN:
+            policy.save_replay_buffer(self._replay_buffer_path(path))
         metrics = training_callback.get_metrics()
         #self.logger.debug(f"{state.idx} TRAINING METRICS: {metrics}")
-        sr_test = self.test_policy(policy)
+        if self.early_stopping:
+            metrics.update(early_stopping_callback.get_metrics())
+        if self.profile:
+            metrics.update(self._get_timings(model.get_env()))
+            metrics["time_training"] = time_training
+            metrics["time_reward_step"] = metrics["time_reward_func"] / max(1, timesteps)
+            metrics["slow_reward_func"] = metrics["time_reward_step"] > self.slow_reward_step
+            self.logger.info(
+                f"state {state.idx} profile: training {time_training:.1f}s, env step {metrics['time_env_step']:.1f}s, "
+                f"reward {metrics['time_reward_func']:.1f}s, success {metrics['time_success_func']:.1f}s, update {metrics['time_update']:.1f}s"
+            )
+        else:
+            metrics.pop("time_update")
+        if metrics.get("hopeless", False):
+            sr_test = early_stopping_callback.eval_history[-1] # no need of the full test
+        elif self.nb_vec_envs > 1:
+            sr_test, returns, lengths = self.test_policy_vec(policy)
+            metrics["test_returns"] = returns
+            metrics["test_lengths"] = lengths
+        else:
+            sr_test = self.test_policy(policy)
         objective_metric = self.objective_metric(metrics.pop('observations'))
         if objective_metric is not None:
             metrics.update(objective_metric)
         metrics["sr"] = sr_test
-        if os.name == "posix":
-            queue.put([state.idx, path, metrics])
-        else:
-            self.memory[state.idx].set_performances(metrics)
-            self.memory[state.idx].set_policy(path)
+        if self.trajectories is not None and self.trajectory_episodes > 0:
+            rollouts = self.trajectories.rollout(policy, self.trajectory_episodes, seed=self.seed + state.idx)
+            metrics.update({f"rollout_{field}": value for field, value in rollouts.items()})
         self.logger.info(f"state {state.idx} has finished learning with performances: {sr_test}")
+        return path, metrics
+
+    def _learning_job(self, state: State, timesteps: int = None) -> tuple[str, dict]:
+        """
+        Train a policy in a worker, the performances are written on disk
+        to only send back a small descriptor to the parent
+
+        Args:
+            state (State): the state to train
+            timesteps (int, optional): the number of timesteps to train. Defaults to timeout.
+
+        Returns:
+            tuple[str, dict]: the path of the saved policy, the descriptor of the performances
+        """
+        path, metrics = self._learning(state, timesteps)
+        name = f"{self.env_name}_{self.seed}_{state.idx}_{os.getpid()}"
+        return path, self.metrics_store.dump(metrics, name)
 
+    def _get_timings(self, env: VecEnv) -> dict[str, float]:
+        """
+        Sum the durations measured by the reward wrappers of the training envs
 
-    def start_learning(self, idx: int) -> None:
+        Args:
+            env (VecEnv): the training envs
+
+        Returns:
+            dict[str, float]: the time spent in the env steps, the reward function and the success function
+        """
+        timings = {"time_env_step": 0.0, "time_reward_func": 0.0, "time_success_func": 0.0}
+        if isinstance(env, VecCustomRewardWrapper):
+            timings["time_reward_func"] += env.timings["reward_func"]
+        for env_timings in env.get_attr("timings"):
+            for key, value in env_timings.items():
+                timings[f"time_{key}"] += value
+        return timings
+
+    def start_learning(self, idx: int, timesteps: int = None) -> None:
         """
         Start the learning process for a given state
         
         Args:
             idx (int): the index of the state to train
+            timesteps (int, optional): the number of timesteps to train, if given an already
+                trained state resumes from its checkpoint. Defaults to None (timeout, from scratch).
         """
+        if timesteps is not None:
+            self.memory[idx].performances = None
+        if self._prescreen(idx):
+            return
+        if self._load_cached_training(idx, timesteps):
+            return
         if os.name == "posix":
-            self._start_proccess_learning(idx)
+            self._collect(timeout=0)
+            self._start_proccess_learning(idx, timesteps)
         else:
-            self._learning(self.memory[idx])
+            path, metrics = self._learning(self.memory[idx], timesteps)
+            self._add_trajectories(metrics)
+            self.memory[idx].set_policy(path)
+            self.memory[idx].set_performances(metrics)
+            self._cache_training(idx)
+
+    def _prescreen(self, idx: int) -> bool:
+        """
+        Score a new reward function on the labelled trajectories, a reward function under
+        the cutoff is not trained and gets a null success rate
+
+        Args:
+            idx (int): the index of the state
+
+        Returns:
+            bool: True if the state is rejected without training
+        """
+        state = self.memory[idx]
+        if self.trajectories is None or state.reward_func is None or state.policy is not None:
+            return False
+        if self.trajectories.frozen is None:
+            self.trajectories.freeze() # in this process, the next prescreens use the same trajectories
+        if self.prescreen_sandbox is None:
+            score = self.trajectories.score(state.reward_func)
+        else:
+            try:
+                # the generated code only runs on the whole dataset with time and memory limits
+                score = self.prescreen_sandbox.call(self.trajectories.score, state.reward_func)
+            except SandboxError as e:
+                self.logger.warning(f"state {idx} prescreen failed: {e}")
+                score = 0.0
+        if score is None:
+            return False
+        self.logger.info(f"state {idx} prescreen score: {score:.2f}")
+        if score >= self.prescreen_cutoff:
+            return False
+        self.logger.warning(f"state {idx} is not trained, its prescreen score is under {self.prescreen_cutoff}")
+        state.set_performances(
+            {"rewards": [], "mean_reward": 0, "std_reward": 0, "sr": 0.0, "prescreened": True, "prescreen_score": score}
+        )
+        return True
+
+    def _add_trajectories(self, metrics: dict) -> None:
+        """
+        Move the rollouts made by a training worker from its performances to the labelled trajectories
 
-    def _start_proccess_learning(self, idx: int) -> None:
+        Args:
+            metrics (dict): the performances of the training, without the rollouts after the call
+        """
+        rollouts = {
+            field: metrics.pop(f"rollout_{field}") for field in TRAJECTORY_FIELDS if f"rollout_{field}" in metrics
+        }
+        if self.trajectories is not None and len(rollouts) == len(TRAJECTORY_FIELDS):
+            self.trajectories.add(rollouts)
+
+    def freeze_trajectories(self) -> None:
+        """
+        Fix the labelled trajectories used by the prescreen until the next call,
+        the rollouts of the trainings finished meanwhile are only used after
+        """
+        if self.trajectories is not None:
+            self.trajectories.freeze()
+
+    def _cache_config(self, idx: int, timesteps: int = None) -> str:
+        """
+        Get the training configuration of a state for the code cache,
+        only the trainings from scratch are cached. The seed is not in the configuration,
+        a training of another run is reused as one more sample of the reward function.
+
+        Args:
+            idx (int): the index of the state to train
+            timesteps (int, optional): the number of timesteps to train. Defaults to None (timeout).
+
+        Returns:
+            str: the configuration, None if the training can not be cached
+        """
+        state = self.memory[idx]
+        if self.code_cache is None or state.reward_func_str is None or state.policy is not None:
+            return None
+        if self.warm_start and state.parent is not None:
+            return None
+        timesteps = self.timeout if timesteps is None else timesteps
+        early_stopping = ""
+        if self.early_stopping:
+            early_stopping = "_es" + "".join(f"_{key}{value}" for key, value in sorted(self.early_stopping_options.items()))
+        return f"{self.algo.value}_{timesteps}_{self.nb_vec_envs}{early_stopping}"
+
+    def _load_cached_training(self, idx: int, timesteps: int = None) -> bool:
+        """
+        Reuse the training of a reward function already trained with the same configuration
+
+        Args:
+            idx (int): the index of the state to train
+            timesteps (int, optional): the number of timesteps to train. Defaults to None (timeout).
+
+        Returns:
+            bool: True if the state got its policy and its performances from the cache
+        """
+        config = self._cache_config(idx, timesteps)
+        if config is None:
+            return False
+        key = self.code_cache.key(self.memory[idx].reward_func_str)
+        training = self.code_cache.get_training(key, config)
+        if training is None:
+            self.cache_configs[idx] = config
+            return False
+        self.logger.info(f"state {idx} training cache hit {key[:8]} ({config})")
+        performances = {
+            name: np.asarray(value) if isinstance(value, list) else value
+            for name, value in training["performances"].items()
+        }
+        self.memory[idx].set_policy(training["policy"])
+        self.memory[idx].set_performances(performances)
+        return True
+
+    def _cache_training(self, idx: int) -> None:
         """
-        Start the learning process for a given state in a new process
+        Record a finished training in the code cache, the checkpoint is copied
+        since the next runs overwrite the checkpoints of the same index
+
+        Args:
+            idx (int): the index of the trained state
+        """
+        config = self.cache_configs.pop(idx, None)
+        state = self.memory[idx]
+        if config is None or state.performances.get("crashed", False):
+            return
+        key = self.code_cache.key(state.reward_func_str)
+        if self.code_cache.get(key) is None:
+            return
+        policy = os.path.join(os.path.dirname(self.code_cache.path), f"{key}_{config}.pth")
+        os.makedirs(os.path.dirname(policy), exist_ok=True)
+        shutil.copy(state.policy, policy)
+        self.code_cache.set_training(key, config, policy, state.performances)
+
+    def _start_proccess_learning(self, idx: int, timesteps: int = None) -> None:
+        """
+        Submit the learning process of a given state to the scheduler,
+        it starts in a new process as soon as a worker is free
         
         Args:
             idx (int): the index of the state to train
+            timesteps (int, optional): the number of timesteps to train. Defaults to None.
         """
         assert (os.name == "posix"), "multi-proccess features only available on LINUX system..."
-        if self.memory[idx].policy is None:
-            self.multi_process.append(
-                Process(
-                    target=self._learning, args=(self.memory[idx], self.queue)
+        if self.memory[idx].policy is None or timesteps is not None:
+            self.scheduler.submit(idx, self._learning_job, (self.memory[idx], timesteps))
+
+    def _collect(self, timeout: float = None) -> None:
+        """
+        Wait for the next finished trainings and record their results in the memory
+
+        Args:
+            timeout (float, optional): maximum time to wait in seconds, 0 to only poll.
+                Defaults to None (wait forever).
+        """
+        for idx, result, error in self.scheduler.wait(timeout):
+            if error is not None:
+                self.logger.error(f"the training of state {idx} has crashed:\n{error}")
+                self.memory[idx].set_performances(
+                    {"rewards": [], "mean_reward": 0, "std_reward": 0, "sr": 0.0, "crashed": True}
                 )
-            )
-            self.to_join.append(idx)
-            self.multi_process[-1].start()
-            self.to_get += 1
+            else:
+                metrics = self.metrics_store.load(result[1])
+                self._add_trajectories(metrics)
+                self.memory[idx].set_policy(result[0])
+                self.memory[idx].set_performances(metrics)
+            self._cache_training(idx)
+
+    def as_completed(self, list_idx: list[int]) -> Generator[int, None, None]:
+        """
+        Yield the states as soon as their training is finished, a crashed training
+        is yielded too, with a null success rate
+
+        Args:
+            list_idx (list[int]): the indexes of the states to wait
+
+        Yields:
+            int: the index of a state which has its performances
+        """
+        remaining = list(list_idx)
+        for i in remaining:
+            if self.memory[i].performances is None and (os.name != "posix" or not self.scheduler.is_scheduled(i)):
+                self.logger.error("Need to start_learning before evaluate him")
+                raise RuntimeError
+        while remaining:
+            for i in [i for i in remaining if self.memory[i].performances is not None]:
+                remaining.remove(i)
+                yield i
+            if remaining:
+                self._collect()
+
+    def get_threshold(self) -> float:
+        """
+        Get the success rate under which a state is considered as a worst,
+        wait for the legacy training if needed
+
+        Returns:
+            float: the threshold
+        """
+        if self.legacy_training:
+            for _ in self.as_completed([0]):
+                pass
+            return self.memory[0].performances["sr"]
+        return 0.9
+
+    def is_worst(self, idx: int, threshold: float) -> bool:
+        """
+        Check if a trained state is under the threshold, or stopped early as hopeless
+
+        Args:
+            idx (int): the index of the state
+            threshold (float): the threshold given by get_threshold
+
+        Returns:
+            bool: True if the state need to be refined
+        """
+        performances = self.memory[idx].performances
+        return threshold > performances["sr"] or performances.get("hopeless", False)
 
     def evaluate_policy(self, list_idx: list[int]) -> tuple[list[int], list[int], float]:
         """
@@ -124,39 +470,72 @@ class PolicyTrainer:
         if len(self.memory) < 2:
             self.logger.warning("At least two reward functions are required.")
 
-        for i in list_idx:
-            if self.memory[i].policy is None and i not in self.to_join:
-                self.logger.error("Need to start_learning before evaluate him")
-                raise RuntimeError
-
-        if os.name == "posix": # waiting proccess
-            while self.to_get != 0:
-                try:
-                    get = self.queue.get(block=False)
-                    self.memory[get[0]].set_policy(get[1])
-                    self.memory[get[0]].set_performances(get[2])
-                    self.to_get -= 1
-                except Empty:
-                    sleep(0.5)
-
-            for p in self.to_join:
-                p = p if self.legacy_training else p-1 # Corresponding idx if not inital training
-                self.multi_process[p].join()
+        for _ in self.as_completed(list_idx):
+            pass
 
         are_worsts: list[int] = []
         are_betters: list[int] = []
-        if self.legacy_training:
-            threshold: float = self.memory[0].performances["sr"]
-        else:
-            threshold: float = 0.9
+        threshold: float = self.get_threshold()
         self.logger.info(f"the threshold is {threshold}")
         for i in list_idx:
-            if threshold > self.memory[i].performances["sr"]:
+            if self.is_worst(i, threshold):
                 are_worsts.append(i)
             else:
                 are_betters.append(i)
         return are_worsts, are_betters, threshold
 
+    def halving_budgets(self, nb_candidates: int, eta: int = 2) -> list[int]:
+        """
+        Split the budget of nb_candidates full trainings between the rungs of a successive halving,
+        each rung gets the same share, divided between its survivors
+
+        Args:
+            nb_candidates (int): the number of reward functions at the first rung
+            eta (int, optional): only 1/eta of the candidates survive to each rung. Defaults to 2.
+
+        Returns:
+            list[int]: the number of timesteps added to each survivor at each rung
+        """
+        rungs_size = [nb_candidates]
+        while rungs_size[-1] > 1 and len(rungs_size) < nb_candidates:
+            rungs_size.append(ceil(rungs_size[-1] / eta))
+        if len(rungs_size) > 1:
+            rungs_size.pop() # the last survivor is not trained again
+        total = nb_candidates * self.timeout
+        return [max(1, total // (len(rungs_size) * size)) for size in rungs_size]
+
+    def successive_halving(self, list_idx: list[int], eta: int = 2) -> int:
+        """
+        Train the candidates with a small budget, drop the worst ones and
+        resume the survivors from their checkpoint with a larger budget, until one survives.
+        The states not started yet are started with the first rung budget.
+
+        Args:
+            list_idx (list[int]): the indexes of the candidates
+            eta (int, optional): only 1/eta of the candidates survive to each rung. Defaults to 2.
+
+        Returns:
+            int: the index of the surviving state
+        """
+        budgets = self.halving_budgets(len(list_idx), eta)
+        survivors = list(list_idx)
+        for rung, budget in enumerate(budgets):
+            for idx in survivors:
+                scheduled = os.name == "posix" and self.scheduler.is_scheduled(idx)
+                if rung > 0 or (self.memory[idx].performances is None and not scheduled):
+                    self.start_learning(idx, budget)
+            for _ in self.as_completed(survivors):
+                pass
+            ranking = sorted(
+                survivors,
+                key=lambda i: (self.memory[i].performances["sr"], self.memory[i].performances["mean_reward"]),
+                reverse=True,
+            )
+            survivors = ranking[:ceil(len(ranking) / eta)]
+            self.logger.info(f"rung {rung} (+{budget} timesteps): ranking {ranking}, survivors {survivors}")
+            getLoggerCSV().rung_to_csv(rung, budget, [self.memory[i] for i in ranking], len(survivors))
+        return survivors[0]
+
     def test_policy(
         self,
         policy,
@@ -203,6 +582,61 @@ class PolicyTrainer:
         return success_rate
 
 
+    def test_policy_vec(
+        self,
+        policy,
+        nb_episodes: int = 100,
+        nb_envs: int = None,
+    ) -> tuple[float, np.ndarray, np.ndarray]:
+        """
+        Test a policy on environments running in parallel processes,
+        the observations of all the envs are predicted in one batch
+
+        Args:
+            policy (BasePolicy): the policy to test
+            nb_episodes (int, optional): the number of episodes to test. Defaults to 100.
+            nb_envs (int, optional): the number of parallel envs. Defaults to nb_vec_envs.
+
+        Returns:
+            tuple[float, np.ndarray, np.ndarray]: the success rate of the policy,
+                the return and the length of each episode
+        """
+        nb_envs = nb_envs or self.nb_vec_envs
+        env = make_vec_env(
+            self.env_name,
+            n_envs=nb_envs,
+            vec_env_cls=SubprocVecEnv,
+            wrapper_class=CustomRewardWrapper,
+            wrapper_kwargs={"success_func": self.success_func},
+        )
+        # same number of episodes per env, to not favor the envs with short episodes
+        targets = np.array([(nb_episodes + i) // nb_envs for i in range(nb_envs)])
+        counts = np.zeros(nb_envs, dtype=int)
+        current_returns = np.zeros(nb_envs)
+        current_lengths = np.zeros(nb_envs, dtype=int)
+        all_returns = []
+        all_lengths = []
+        nb_success = 0
+        obs = env.reset()
+        while (counts < targets).any():
+            actions, _ = policy.predict(obs)
+            obs, rewards, dones, infos = env.step(actions)
+            current_returns += rewards
+            current_lengths += 1
+            for i in np.flatnonzero(dones):
+                if counts[i] < targets[i]:
+                    all_returns.append(current_returns[i])
+                    all_lengths.append(current_lengths[i])
+                    if infos[i].get("is_success", False):
+                        nb_success += 1
+                    counts[i] += 1
+                current_returns[i] = 0
+                current_lengths[i] = 0
+        env.close()
+
+        success_rate = nb_success / nb_episodes
+        return success_rate, np.array(all_returns), np.array(all_lengths)
+
     def start_hf(self, policy_path: str, nb_episodes: int = 10):
         """
         Start the test of a policy to evaluate its performances
@@ -213,13 +647,11 @@ class PolicyTrainer:
             
         """
         if os.name == "posix":
-            self.multi_process.append(
-                Process(
-                    target=self.test_policy_hf, args=(policy_path, nb_episodes)
-                )
+            process = Process(
+                target=self.test_policy_hf, args=(policy_path, nb_episodes)
             )
-            self.multi_process[-1].start()
-            self.multi_process[-1].join()
+            process.start()
+            process.join()
         else:
             self.test_policy_hf(policy_path, nb_episodes)
 
@@ -268,13 +700,11 @@ class PolicyTrainer:
             
         """
         if os.name == "posix":
-            self.multi_process.append(
-                Process(
-                    target=self.test_policy_video, args=(policy_path, nb_episodes, idx)
-                )
+            process = Process(
+                target=self.test_policy_video, args=(policy_path, nb_episodes, idx)
             )
-            self.multi_process[-1].start()
-            self.multi_process[-1].join()
+            process.start()
+            process.join()
         else:
             self.test_policy_video(policy_path, nb_episodes, idx)
 
@@ -304,12 +734,27 @@ class PolicyTrainer:
                 env.render()
         env.close()
 
-    def _generate_env_model(self, reward_func) -> tuple[VecEnv, PPO, int]:
+    def _replay_buffer_path(self, policy_path: str) -> str:
+        """
+        Get the path of the replay buffer saved next to a DQN policy
+
+        Args:
+            policy_path (str): the path of the policy
+
+        Returns:
+            str: the path of the replay buffer
+        """
+        return os.path.splitext(policy_path)[0] + "_replay_buffer.pkl"
+
+    def _generate_env_model(self, reward_func, load_path: str = None, warm_start_path: str = None) -> tuple[VecEnv, PPO, int]:
         """
         Generate the environment model
 
         Args:
             reward_func (Callable): the generated reward function
+            load_path (str, optional): the checkpoint to resume from. Defaults to None.
+            warm_start_path (str, optional): the checkpoint to copy the weights from,
+                the training starts again from zero timesteps. Defaults to None.
 
         Raises:
             ValueError: if algo not implemented
@@ -319,22 +764,40 @@ class PolicyTrainer:
         """
         if self.nb_vec_envs == 1:
             self.logger.debug("simple env")
-            env = gym.make(self.env_name) # , terminate_when_unhealthy=False
-            env = CustomRewardWrapper(env, self.success_func, reward_func)
+            env = gym.make(self.env_name) # , terminate_when_unhealthy=False
+            env = CustomRewardWrapper(env, self.success_func, reward_func, self.profile)
         else:
             env = make_vec_env(
                 self.env_name,
                 n_envs=self.nb_vec_envs,
                 wrapper_class=CustomRewardWrapper,
-                wrapper_kwargs={"success_func": self.success_func, "llm_reward_function": reward_func},
+                wrapper_kwargs={"success_func": self.success_func, "profile": self.profile},
                 # env_kwargs={'terminate_when_unhealthy': False}
             )
+            # a numba compiled function is specialized for one observation, its python version takes the batch
+            batch_func = getattr(reward_func, "py_func", reward_func)
+            if VecCustomRewardWrapper.is_vectorizable(batch_func, env.observation_space):
+                self.logger.debug("vectorized reward function")
+                env = VecCustomRewardWrapper(env, batch_func, self.profile)
+            else:
+                env.set_attr("llm_reward_function", reward_func)
         if self.algo == Algo.PPO:
-            model = PPO(env=env, **self.algo_param)
+            algo_class = PPO
         elif self.algo == Algo.DQN:
             # use gym.make instead of make_vec_env for DQN. gym 10min / vec_env 2h
-            model = DQN(env=env, **self.algo_param)
+            algo_class = DQN
         else:
             raise ValueError("The learning algorithm is not implemented.")
+        if load_path is None:
+            model = algo_class(env=env, **self.algo_param)
+        else:
+            model = algo_class.load(load_path, env=env)
+        if warm_start_path is not None:
+            self.logger.debug(f"warm start from {warm_start_path}")
+            model.set_parameters(warm_start_path)
+        # the rewards stored in the buffer of the parent come from its reward function, only a resume
+        # with the same reward function reuses the buffer
+        if load_path is not None and self.algo == Algo.DQN and os.path.exists(self._replay_buffer_path(load_path)):
+            model.load_replay_buffer(self._replay_buffer_path(load_path))
 
         return model
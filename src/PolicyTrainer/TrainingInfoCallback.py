@@ -1,21 +1,36 @@
+from time import perf_counter
+
 import numpy as np
 from stable_baselines3.common.callbacks import BaseCallback
 
 
 class TrainingInfoCallback(BaseCallback):
-    def __init__(self):
+    def __init__(self, nb_bins: int = 20, hist_range: float = 10.0, reservoir_size: int = 0):
         """
-        Callback for harvest training information
-        
+        Callback for harvest training information,
+        the observations are summarized on the fly in a memory of O(obs_dim)
+
+        Args:
+            nb_bins (int, optional): number of bins of the histogram of each observation dimension. Defaults to 20.
+            hist_range (float, optional): range of the histogram for the unbounded dimensions. Defaults to 10.0.
+            reservoir_size (int, optional): number of observations uniformly sampled
+                during the training, 0 to disable. Defaults to 0.
         """
         super().__init__()
         self.training_metrics = {
-            "episode_rewards": [], 
-            "episode_observations": [], 
-            "episode_lengths": [], 
+            "episode_rewards": [],
+            "episode_original_rewards": [],
+            "episode_lengths": [],
         }
+        self.nb_bins = nb_bins
+        self.hist_range = hist_range
+        self.reservoir_size = reservoir_size
+
+        self.time_update = 0.0
+        self.rollout_end = None
 
         self.current_episode_rewards = None
+        self.current_episode_original_rewards = None
         self.current_episode_lengths = None
         self.num_envs = None
 
@@ -23,8 +38,79 @@ class TrainingInfoCallback(BaseCallback):
         """
         Call at the start of the training
         """
-        self.current_episode_rewards = 0
-        self.current_episode_lengths = 0
+        self.num_envs = self.training_env.num_envs
+        self.current_episode_rewards = np.zeros(self.num_envs)
+        self.current_episode_original_rewards = np.zeros(self.num_envs)
+        self.current_episode_lengths = np.zeros(self.num_envs, dtype=np.int64)
+        obs_dim = int(np.prod(self.training_env.observation_space.shape))
+        low = np.asarray(self.training_env.observation_space.low, dtype=np.float64).reshape(-1)
+        high = np.asarray(self.training_env.observation_space.high, dtype=np.float64).reshape(-1)
+        low = np.where(np.isfinite(low), low, -self.hist_range)
+        high = np.where(np.isfinite(high), high, self.hist_range)
+        self.obs_count = 0
+        self.obs_mean = np.zeros(obs_dim)
+        self.obs_m2 = np.zeros(obs_dim)
+        self.obs_abs_mean = np.zeros(obs_dim)
+        self.obs_min = np.full(obs_dim, np.inf)
+        self.obs_max = np.full(obs_dim, -np.inf)
+        self.obs_first = None
+        self.obs_last = np.zeros(obs_dim)
+        self.bin_edges = np.linspace(low, high, self.nb_bins + 1, axis=1)
+        self.histogram = np.zeros((obs_dim, self.nb_bins), dtype=np.int64)
+        self.reservoir = np.zeros((self.reservoir_size, obs_dim))
+        self.rng = np.random.default_rng()
+
+    def _update_observations(self, obs: np.ndarray) -> None:
+        """
+        Update the running statistics with a batch of observations
+
+        Args:
+            obs (np.ndarray): the observations of the vectorized envs, shape (n_envs, *obs_shape)
+        """
+        obs = np.asarray(obs, dtype=np.float64).reshape(len(obs), -1)
+        if self.obs_first is None:
+            self.obs_first = obs[0].copy()
+        self.obs_last = obs[-1].copy()
+        # Chan et al. parallel update of the mean and the sum of squared differences
+        n_batch = len(obs)
+        batch_mean = obs.mean(axis=0)
+        delta = batch_mean - self.obs_mean
+        total = self.obs_count + n_batch
+        self.obs_mean += delta * n_batch / total
+        self.obs_m2 += ((obs - batch_mean) ** 2).sum(axis=0) + delta ** 2 * self.obs_count * n_batch / total
+        self.obs_abs_mean += (np.abs(obs).sum(axis=0) - n_batch * self.obs_abs_mean) / total
+        np.minimum(self.obs_min, obs.min(axis=0), out=self.obs_min)
+        np.maximum(self.obs_max, obs.max(axis=0), out=self.obs_max)
+
+        width = self.bin_edges[:, -1] - self.bin_edges[:, 0]
+        bins = ((obs - self.bin_edges[:, 0]) / np.where(width > 0, width, 1) * self.nb_bins).astype(np.int64)
+        np.clip(bins, 0, self.nb_bins - 1, out=bins)
+        np.add.at(self.histogram, (np.broadcast_to(np.arange(bins.shape[1]), bins.shape), bins), 1)
+
+        if self.reservoir_size > 0:
+            for i in range(n_batch):  # Algorithm R
+                seen = self.obs_count + i
+                if seen < self.reservoir_size:
+                    self.reservoir[seen] = obs[i]
+                else:
+                    j = self.rng.integers(0, seen + 1)
+                    if j < self.reservoir_size:
+                        self.reservoir[j] = obs[i]
+        self.obs_count = total
+
+    def _on_rollout_start(self) -> None:
+        """
+        Call before collecting a rollout, the time since the end of the last one is spent in the gradient updates
+        """
+        if self.rollout_end is not None:
+            self.time_update += perf_counter() - self.rollout_end
+            self.rollout_end = None
+
+    def _on_rollout_end(self) -> None:
+        """
+        Call after collecting a rollout, the gradient updates come next
+        """
+        self.rollout_end = perf_counter()
 
     def _on_step(self) -> bool:
         """
@@ -33,36 +119,74 @@ class TrainingInfoCallback(BaseCallback):
         obs = self.locals["new_obs"]
         rewards = self.locals["rewards"]
         dones = self.locals["dones"]
+        infos = self.locals["infos"]
 
-        self.current_episode_rewards += rewards[0]
+        self.current_episode_rewards += rewards
+        self.current_episode_original_rewards += np.fromiter(
+            (info.get("original_reward", reward) for info, reward in zip(infos, rewards)),
+            dtype=np.float64,
+            count=self.num_envs,
+        )
         self.current_episode_lengths += 1
-        self.training_metrics["episode_observations"].append(
-                    obs[0]
-                )
-        if dones[0]:
+        self._update_observations(obs)
+        for i in np.flatnonzero(dones):
             self.training_metrics["episode_rewards"].append(
-                self.current_episode_rewards
+                self.current_episode_rewards[i]
+            )
+            self.training_metrics["episode_original_rewards"].append(
+                self.current_episode_original_rewards[i]
             )
             self.training_metrics["episode_lengths"].append(
-                self.current_episode_lengths
+                self.current_episode_lengths[i]
             )
-            self.current_episode_rewards = 0
-            self.current_episode_lengths = 0
+            self.current_episode_rewards[i] = 0
+            self.current_episode_original_rewards[i] = 0
+            self.current_episode_lengths[i] = 0
         return True
 
+    def get_observations_summary(self) -> dict:
+        """
+        Get the summary of the observations seen during the training
+
+        Returns:
+            dict: count, mean, std, abs_mean, min, max, first, last (shape (obs_dim,)),
+                histogram (shape (obs_dim, nb_bins)), bin_edges (shape (obs_dim, nb_bins + 1))
+                and reservoir (shape (min(count, reservoir_size), obs_dim))
+        """
+        return {
+            "count": self.obs_count,
+            "mean": self.obs_mean,
+            "std": np.sqrt(self.obs_m2 / max(1, self.obs_count)),
+            "abs_mean": self.obs_abs_mean,
+            "min": self.obs_min,
+            "max": self.obs_max,
+            "first": self.obs_first,
+            "last": self.obs_last,
+            "histogram": self.histogram,
+            "bin_edges": self.bin_edges,
+            "reservoir": self.reservoir[:min(self.obs_count, self.reservoir_size)],
+        }
+
     def _on_training_end(self) -> None:
         """
         Call at the end of the training
         """
-        rewards = self.training_metrics["episode_rewards"]
+        self._on_rollout_start()
+        rewards = np.array(self.training_metrics["episode_rewards"])
         rewards /= np.linalg.norm(rewards)
-        lengths = self.training_metrics["episode_lengths"]
+        original_rewards = np.array(self.training_metrics["episode_original_rewards"])
+        lengths = np.array(self.training_metrics["episode_lengths"])
 
         self.custom_metrics = {
-            "observations": self.training_metrics["episode_observations"],
+            "observations": self.get_observations_summary(),
             "rewards": rewards,
             "mean_reward": np.mean(rewards) if rewards.all() else 0,
             "std_reward": np.std(rewards) if len(rewards) > 1 else 0,
+            "original_rewards": original_rewards,
+            "mean_original_reward": np.mean(original_rewards) if len(original_rewards) > 0 else 0,
+            "lengths": lengths,
+            "nb_episodes": len(rewards),
+            "time_update": self.time_update,
         }
 
     def get_metrics(self):
@@ -0,0 +1,326 @@
+import os
+import queue
+import traceback
+from collections import deque
+from logging import getLogger
+from multiprocessing import Array, Pipe, Process, Queue, Semaphore
+from multiprocessing.connection import Connection, wait
+from time import perf_counter, sleep
+from typing import Any, Callable
+
+import torch
+
+
+def _pinned_worker(target: Callable, args: tuple, cores: list[int], conn: Connection) -> None:
+    """
+    Entry point of a training worker, pin it on its cores before running the job
+    and send back the result or the traceback of the job
+
+    Args:
+        target (Callable): the job to run
+        args (tuple): the arguments of the job
+        cores (list[int]): the cores reserved for this worker
+        conn (Connection): the pipe to send the result
+    """
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        conn.send((target(*args), None))
+    except Exception:
+        conn.send((None, traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class SharedSlots:
+    """
+    Slots of cores shared by the schedulers of several processes. A taken slot records
+    the pid of its owner, so the slots of a crashed or killed process can be given back.
+    """
+    POLL = 0.1 # seconds between two tries to take a slot
+
+    def __init__(self, max_workers: int = None, cores_per_worker: int = 1):
+        """
+        Initialize the slots, all free
+
+        Args:
+            max_workers (int, optional): number of slots. Defaults to nb_cores // cores_per_worker.
+            cores_per_worker (int, optional): number of cores of each slot. Defaults to 1.
+        """
+        self.cores = TrainingScheduler.core_slots(max_workers, cores_per_worker)
+        self.queue = Queue()
+        self.owners = Array("i", len(self.cores)) # pid of the owner of each slot, 0 if free
+        for slot in range(len(self.cores)):
+            self.queue.put(slot)
+
+    def get(self, timeout: float = None) -> int:
+        """
+        Take a free slot
+
+        Args:
+            timeout (float, optional): maximum time to wait in seconds, 0 to only try.
+                Defaults to None (wait forever).
+
+        Raises:
+            queue.Empty: if no slot is free before the timeout
+
+        Returns:
+            int: the slot, its cores are cores[slot]
+        """
+        deadline = None if timeout is None else perf_counter() + timeout
+        while True:
+            with self.owners.get_lock(): # a slot is never taken without its owner
+                try:
+                    slot = self.queue.get_nowait()
+                    self.owners[slot] = os.getpid()
+                    return slot
+                except queue.Empty:
+                    pass
+            if deadline is not None and perf_counter() >= deadline:
+                raise queue.Empty
+            sleep(self.POLL if deadline is None else max(0.0, min(self.POLL, deadline - perf_counter())))
+
+    def put(self, slot: int) -> None:
+        """
+        Give back a slot
+
+        Args:
+            slot (int): the slot taken by get
+        """
+        with self.owners.get_lock():
+            self.owners[slot] = 0
+            self.queue.put(slot)
+
+    def release_owner(self, pid: int) -> int:
+        """
+        Give back the slots still taken by a finished process
+
+        Args:
+            pid (int): the pid of the process
+
+        Returns:
+            int: the number of slots given back
+        """
+        slots = [slot for slot in range(len(self.cores)) if self.owners[slot] == pid]
+        for slot in slots:
+            self.put(slot)
+        return len(slots)
+
+
+class SharedLimiter:
+    """
+    Bound of the concurrent requests of several processes, for instance the LLM requests.
+    A taken request records the pid of its holder, like the slots of SharedSlots, so the
+    requests of a crashed or killed process can be given back.
+    """
+    POLL = 0.05 # seconds between two tries to take a request
+
+    def __init__(self, max_requests: int = 1):
+        """
+        Initialize the limiter, all the requests free
+
+        Args:
+            max_requests (int, optional): maximum number of concurrent requests. Defaults to 1.
+        """
+        self.semaphore = Semaphore(max_requests)
+        self.holders = Array("i", max_requests) # pid of the holder of each request, 0 if free
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        Take a request, the threads of a process share its pid
+
+        Args:
+            timeout (float, optional): maximum time to wait in seconds. Defaults to None (wait forever).
+
+        Returns:
+            bool: True if the request is taken, False on timeout
+        """
+        deadline = None if timeout is None else perf_counter() + timeout
+        while True:
+            with self.holders.get_lock(): # a request is never taken without its holder
+                if self.semaphore.acquire(block=False):
+                    self.holders[list(self.holders).index(0)] = os.getpid()
+                    return True
+            if deadline is not None and perf_counter() >= deadline:
+                return False
+            sleep(self.POLL if deadline is None else max(0.0, min(self.POLL, deadline - perf_counter())))
+
+    def release(self) -> None:
+        """
+        Give back a request taken by this process
+        """
+        with self.holders.get_lock():
+            self.holders[list(self.holders).index(os.getpid())] = 0
+            self.semaphore.release()
+
+    def release_owner(self, pid: int) -> int:
+        """
+        Give back the requests still taken by a finished process
+
+        Args:
+            pid (int): the pid of the process
+
+        Returns:
+            int: the number of requests given back
+        """
+        with self.holders.get_lock():
+            requests = [i for i in range(len(self.holders)) if self.holders[i] == pid]
+            for i in requests:
+                self.holders[i] = 0
+                self.semaphore.release()
+        return len(requests)
+
+
+class TrainingScheduler:
+    """
+    Bounded pool of training processes, the jobs over the limit wait in a queue
+    """
+    SHARED_POLL = 1.0 # seconds between two polls of the shared slots
+    SHARED_WARNING = 600.0 # seconds of waiting for a shared slot before a warning
+    def __init__(self, max_workers: int = None, cores_per_worker: int = 1, slots: SharedSlots = None):
+        """
+        Initialize the scheduler
+
+        Args:
+            max_workers (int, optional): maximum number of concurrent trainings.
+                Defaults to nb_cores // cores_per_worker.
+            cores_per_worker (int, optional): number of cores given to each training,
+                usually the number of vectorized envs. Defaults to 1.
+            slots (SharedSlots, optional): the slots shared with the schedulers of other processes,
+                max_workers is then ignored. Defaults to None (own slots).
+        """
+        assert (os.name == "posix"), "multi-proccess features only available on LINUX system..."
+        self.logger = getLogger("VIRAL")
+        self.slots = slots
+        self.free_slots: list[int] = []
+        if slots is None:
+            self.cores = self.core_slots(max_workers, cores_per_worker)
+            self.free_slots = list(range(len(self.cores)))
+        else:
+            self.cores = slots.cores
+        self.pending: deque[tuple[int, Callable, tuple]] = deque()
+        self.running: dict[int, tuple[Process, int, Connection]] = {}
+        self.logger.debug(
+            f"scheduler with {len(self.free_slots) if slots is None else 'shared'} slots"
+        )
+
+    @staticmethod
+    def core_slots(max_workers: int = None, cores_per_worker: int = 1) -> list[list[int]]:
+        """
+        Split the available cores in slots
+
+        Args:
+            max_workers (int, optional): number of slots. Defaults to nb_cores // cores_per_worker.
+            cores_per_worker (int, optional): number of cores of each slot. Defaults to 1.
+
+        Returns:
+            list[list[int]]: the cores of each slot
+        """
+        cores = sorted(os.sched_getaffinity(0))
+        cores_per_worker = max(1, min(cores_per_worker, len(cores)))
+        if max_workers is None:
+            max_workers = len(cores) // cores_per_worker
+        return [
+            [cores[(i * cores_per_worker + j) % len(cores)] for j in range(cores_per_worker)]
+            for i in range(max(1, max_workers))
+        ]
+
+    def submit(self, idx: int, target: Callable, args: tuple) -> None:
+        """
+        Queue a job, it starts as soon as a slot is free
+
+        Args:
+            idx (int): the index of the state trained by the job
+            target (Callable): the job to run, its return value is sent back to the parent
+            args (tuple): the arguments of the job
+        """
+        self.pending.append((idx, target, args))
+        self._dispatch()
+
+    def wait(self, timeout: float = None) -> list[tuple[int, Any, str]]:
+        """
+        Block until at least one running job is finished, join it and start the next pending jobs
+
+        Args:
+            timeout (float, optional): maximum time to wait in seconds, 0 to only poll.
+                Defaults to None (wait forever).
+
+        Returns:
+            list[tuple[int, Any, str]]: (idx, result, error) for every finished job,
+                error is None if the job succeeded, else the traceback or the exit code of the worker
+        """
+        if not self.running and self.slots is not None and self.pending:
+            # every shared slot is taken by the other processes
+            waited = 0.0
+            while not self.free_slots:
+                poll = self.SHARED_POLL if timeout is None else max(0.0, min(self.SHARED_POLL, timeout - waited))
+                try:
+                    self.free_slots.append(self.slots.get(timeout=poll))
+                except queue.Empty:
+                    waited += poll
+                    if timeout is not None and waited >= timeout:
+                        return []
+                    if waited % self.SHARED_WARNING < self.SHARED_POLL:
+                        self.logger.warning(f"no free training slot for {waited:.0f}s")
+            self._dispatch()
+        if not self.running:
+            return []
+        if self.slots is not None and self.pending:
+            # a slot released by another process does not wake us up
+            timeout = self.SHARED_POLL if timeout is None else min(timeout, self.SHARED_POLL)
+        handles = {}
+        for idx, (process, _, conn) in self.running.items():
+            handles[conn] = idx
+            handles[process.sentinel] = idx
+        ready = wait(list(handles.keys()), timeout)
+        finished: list[tuple[int, Any, str]] = []
+        for idx in dict.fromkeys(handles[handle] for handle in ready):
+            process, slot, conn = self.running.pop(idx)
+            try:
+                result, error = conn.recv()
+            except EOFError:
+                process.join()
+                result, error = None, f"worker exited with code {process.exitcode}"
+            process.join()
+            conn.close()
+            if self.slots is None:
+                self.free_slots.append(slot)
+            else:
+                self.slots.put(slot)
+            finished.append((idx, result, error))
+        self._dispatch()
+        return finished
+
+    def is_scheduled(self, idx: int) -> bool:
+        """
+        Check if a job is running or waiting for a slot
+
+        Args:
+            idx (int): the index of the state
+
+        Returns:
+            bool: True if the job is not finished
+        """
+        return idx in self.running or any(job[0] == idx for job in self.pending)
+
+    def _dispatch(self) -> None:
+        """
+        Start pending jobs while there are free slots, own or shared
+        """
+        while self.pending:
+            if not self.free_slots:
+                if self.slots is None:
+                    break
+                try:
+                    self.free_slots.append(self.slots.get(timeout=0))
+                except queue.Empty:
+                    break
+            idx, target, args = self.pending.popleft()
+            slot = self.free_slots.pop(0)
+            cores = self.cores[slot]
+            reader, writer = Pipe(duplex=False)
+            process = Process(target=_pinned_worker, args=(target, args, cores, writer))
+            process.start()
+            writer.close()
+            self.running[idx] = (process, slot, reader)
+            self.logger.debug(f"state {idx} start on cores {cores}")
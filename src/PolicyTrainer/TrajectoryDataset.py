@@ -0,0 +1,238 @@
+import os
+import re
+from logging import getLogger
+from typing import Callable
+
+import numpy as np
+from gymnasium import make
+
+from Environments.EnvType import EnvType
+from utils.utils import atomic_write, file_lock
+
+TRAJECTORY_FIELDS = ("observations", "is_success", "is_failure", "episodes", "labels")
+
+
+class TrajectoryDataset:
+    """
+    Trajectories of an environment labelled successes or failures by its success_func,
+    from random rollouts and from the trained policies. The steps of all the trajectories
+    are stored flat in a .npz, so the returns of a candidate reward function on every
+    trajectory are computed in one vectorized pass.
+    """
+    def __init__(self, env_type: EnvType, directory: str = "data/trajectories", max_steps: int = 200_000):
+        """
+        Initialize the dataset, load the trajectories already collected for this environment
+
+        Args:
+            env_type (EnvType): the environment
+            directory (str, optional): the folder of the .npz files. Defaults to "data/trajectories".
+            max_steps (int, optional): maximum number of stored steps, the oldest trajectories
+                are dropped beyond. Defaults to 200_000.
+        """
+        self.logger = getLogger("VIRAL")
+        self.env_name = str(env_type)
+        self.success_func = env_type.success_func
+        self.max_steps = max_steps
+        safe_name = re.sub(r'[^a-zA-Z0-9_]', '_', self.env_name)
+        self.path = os.path.join(directory, f"{safe_name}.npz")
+        self.observations: np.ndarray = None # observation after each step, shape (nb_steps, *obs_shape)
+        self.is_success = np.zeros(0, dtype=bool) # flags of each step, only set on the last step of a trajectory
+        self.is_failure = np.zeros(0, dtype=bool)
+        self.episodes = np.zeros(0, dtype=np.int64) # trajectory of each step
+        self.labels = np.zeros(0, dtype=bool) # True if the trajectory is a success
+        self.frozen: dict[str, np.ndarray] = None # the trajectories used by score, see freeze
+        self._load()
+        if len(self) > 0:
+            self.logger.info(f"{len(self)} trajectories loaded from: {self.path}")
+
+    def __len__(self) -> int:
+        """
+        Get the number of trajectories
+
+        Returns:
+            int: the number of trajectories
+        """
+        return len(self.labels)
+
+    def _load(self) -> None:
+        """
+        Read the dataset file, with the trajectories added by the other runs
+        """
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path) as data:
+            for field in TRAJECTORY_FIELDS:
+                setattr(self, field, data[field])
+
+    def rollout(self, policy=None, nb_episodes: int = 20, seed: int = None) -> dict[str, np.ndarray]:
+        """
+        Roll out a policy and label its trajectories, without adding them to the dataset
+
+        Args:
+            policy (BasePolicy, optional): the policy, with a predict method. Defaults to None (random actions).
+            nb_episodes (int, optional): the number of trajectories. Defaults to 20.
+            seed (int, optional): the seed of the environment and of the random actions. Defaults to None.
+
+        Returns:
+            dict[str, np.ndarray]: the observations, is_success, is_failure and episodes of the steps,
+                numbered from 0, and the labels of the trajectories
+        """
+        env = make(self.env_name)
+        env.action_space.seed(seed)
+        observations, is_success, is_failure, episodes, labels = [], [], [], [], []
+        for episode in range(nb_episodes):
+            obs, _ = env.reset(seed=seed if episode == 0 else None)
+            done = False
+            while not done:
+                if policy is None:
+                    action = env.action_space.sample()
+                else:
+                    action, _ = policy.predict(obs)
+                obs, _, term, trunc, info = env.step(action)
+                done = term or trunc
+                success, failure = False, False
+                if done:
+                    info["TimeLimit.truncated"] = trunc
+                    info["terminated"] = term
+                    info["obs"] = obs
+                    success, failure = self.success_func(env, info)
+                    labels.append(bool(success))
+                observations.append(obs)
+                is_success.append(bool(success))
+                is_failure.append(bool(failure))
+                episodes.append(episode)
+        env.close()
+        return {
+            "observations": np.array(observations, dtype=np.float32),
+            "is_success": np.array(is_success, dtype=bool),
+            "is_failure": np.array(is_failure, dtype=bool),
+            "episodes": np.array(episodes, dtype=np.int64),
+            "labels": np.array(labels, dtype=bool),
+        }
+
+    def collect(self, policy=None, nb_episodes: int = 20, seed: int = None) -> None:
+        """
+        Roll out a policy and add the labelled trajectories to the dataset
+
+        Args:
+            policy (BasePolicy, optional): the policy, with a predict method. Defaults to None (random actions).
+            nb_episodes (int, optional): the number of trajectories. Defaults to 20.
+            seed (int, optional): the seed of the environment and of the random actions. Defaults to None.
+        """
+        self.add(self.rollout(policy, nb_episodes, seed))
+
+    def add(self, trajectories: dict[str, np.ndarray]) -> None:
+        """
+        Add trajectories given by rollout, drop the oldest ones beyond max_steps and save the dataset.
+        The file is shared by the parallel runs, it is read again under a lock before the update.
+
+        Args:
+            trajectories (dict[str, np.ndarray]): the trajectories given by rollout
+        """
+        if len(trajectories["labels"]) == 0:
+            return
+        with file_lock(self.path):
+            self._load()
+            new_episodes = trajectories["episodes"] + len(self)
+            if self.observations is None:
+                self.observations = trajectories["observations"]
+            else:
+                self.observations = np.concatenate([self.observations, trajectories["observations"]])
+            self.is_success = np.concatenate([self.is_success, trajectories["is_success"]])
+            self.is_failure = np.concatenate([self.is_failure, trajectories["is_failure"]])
+            self.episodes = np.concatenate([self.episodes, new_episodes])
+            self.labels = np.concatenate([self.labels, trajectories["labels"]])
+            if len(self.episodes) > self.max_steps:
+                # keep whole trajectories, renumbered from 0
+                cut = len(self.episodes) - self.max_steps
+                first = self.episodes[cut]
+                if self.episodes[cut - 1] == first: # the trajectory is partially beyond
+                    first += 1
+                kept = self.episodes >= first
+                self.observations = self.observations[kept]
+                self.is_success = self.is_success[kept]
+                self.is_failure = self.is_failure[kept]
+                self.episodes = self.episodes[kept] - first
+                self.labels = self.labels[first:]
+            arrays = {field: getattr(self, field) for field in TRAJECTORY_FIELDS}
+            atomic_write(self.path, lambda file: np.savez(file, **arrays), mode="wb")
+        self.logger.info(
+            f"{len(trajectories['labels'])} trajectories added ({int(np.sum(trajectories['labels']))} successes), "
+            f"{len(self)} in the dataset"
+        )
+
+    def freeze(self) -> None:
+        """
+        Fix the trajectories used by score to the current ones, so the scores do not depend
+        on the order in which the trainings add their rollouts
+        """
+        self.frozen = {field: getattr(self, field) for field in TRAJECTORY_FIELDS} # the arrays are replaced, never modified
+
+    def returns(self, reward_func: Callable) -> np.ndarray:
+        """
+        Compute the return of every frozen trajectory under a reward function, with one call
+        on all the steps if the function is vectorizable, else one call per step
+
+        Args:
+            reward_func (Callable): the reward function
+
+        Returns:
+            np.ndarray: the return of each trajectory, shape (nb_trajectories,)
+        """
+        if self.frozen is None:
+            self.freeze()
+        observations, is_success, is_failure = (
+            self.frozen["observations"], self.frozen["is_success"], self.frozen["is_failure"]
+        )
+        episodes = self.frozen["episodes"]
+        batch_func = getattr(reward_func, "py_func", reward_func) # the python version of a numba function
+        rewards = None
+        with np.errstate(all="ignore"):
+            try:
+                rewards = np.asarray(batch_func(observations, is_success, is_failure), dtype=np.float64)
+                probes = np.concatenate([ # some steps and some ends of trajectory
+                    np.linspace(0, len(episodes) - 1, 8).astype(int),
+                    np.flatnonzero(is_success | is_failure)[:8],
+                ])
+                single = [reward_func(observations[i], is_success[i], is_failure[i]) for i in probes]
+                if rewards.shape != episodes.shape or not np.allclose(rewards[probes], single, equal_nan=True):
+                    rewards = None
+            except Exception:
+                rewards = None
+            if rewards is None:
+                rewards = np.fromiter(
+                    (reward_func(obs, s, f) for obs, s, f in zip(observations, is_success, is_failure)),
+                    dtype=np.float64, count=len(episodes),
+                )
+        return np.bincount(episodes, weights=rewards, minlength=len(self.frozen["labels"]))
+
+    def score(self, reward_func: Callable) -> float:
+        """
+        Score how well the returns of a reward function separate the successful frozen trajectories
+        from the failed ones: the probability that a success has a higher return than a failure
+        (area under the ROC curve, 0.5 for a reward blind to the goal)
+
+        Args:
+            reward_func (Callable): the reward function
+
+        Returns:
+            float: the score in [0, 1], None if the dataset has no success or no failure to compare
+        """
+        if self.frozen is None:
+            self.freeze()
+        labels = self.frozen["labels"]
+        nb_successes = int(np.sum(labels))
+        if nb_successes == 0 or nb_successes == len(labels):
+            return None
+        try:
+            returns = self.returns(reward_func)
+        except Exception as e:
+            self.logger.warning(f"the reward function fails on the trajectory dataset: {e}")
+            return 0.0
+        if not np.all(np.isfinite(returns)):
+            return 0.0
+        failures = np.sort(returns[~labels])
+        successes = returns[labels]
+        below = np.searchsorted(failures, successes, side="left")
+        ties = np.searchsorted(failures, successes, side="right") - below
+        return float((below.sum() + 0.5 * ties.sum()) / (len(successes) * len(failures)))
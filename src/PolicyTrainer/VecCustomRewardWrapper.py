@@ -0,0 +1,89 @@
+from time import perf_counter
+from typing import Callable
+
+import gymnasium as gym
+import numpy as np
+from stable_baselines3.common.vec_env import VecEnv, VecEnvWrapper
+
+
+class VecCustomRewardWrapper(VecEnvWrapper):
+    def __init__(self, venv: VecEnv, llm_reward_function: Callable, profile: bool = False):
+        """
+        Compute the generated reward function once per step on the batch of observations of all the envs.
+        The envs must be wrapped by a CustomRewardWrapper without reward function,
+        which gives is_success and is_failure in their infos.
+
+        Args:
+            venv (VecEnv): the vectorized environments
+            llm_reward_function (Callable): the generated reward function, vectorizable with numpy
+            profile (bool, optional): accumulate the time spent in the reward function. Defaults to False.
+        """
+        super().__init__(venv)
+        self.llm_reward_function = llm_reward_function
+        self.profile = profile
+        self.timings = {"reward_func": 0.0}
+
+    @staticmethod
+    def is_vectorizable(llm_reward_function: Callable, observation_space: gym.Space, nb_probes: int = 8) -> bool:
+        """
+        Check if a reward function gives the same rewards on a batch than observation by observation
+
+        Args:
+            llm_reward_function (Callable): the generated reward function
+            observation_space (gym.Space): the observation space of one env
+            nb_probes (int, optional): the size of the probe batch. Defaults to 8.
+
+        Returns:
+            bool: True if the reward function can be called on a batch
+        """
+        observations = np.stack([observation_space.sample() for _ in range(nb_probes)])
+        is_success = np.arange(nb_probes) % 3 == 1
+        is_failure = np.arange(nb_probes) % 3 == 2
+        try:
+            with np.errstate(all="ignore"):
+                batch = np.asarray(
+                    llm_reward_function(observations, is_success, is_failure), dtype=np.float64
+                )
+                single = np.array(
+                    [llm_reward_function(observations[i], is_success[i], is_failure[i]) for i in range(nb_probes)],
+                    dtype=np.float64,
+                )
+        except Exception:
+            return False
+        return batch.shape == (nb_probes,) and np.allclose(batch, single, equal_nan=True)
+
+    def reset(self) -> np.ndarray:
+        """
+        Reset all the environments
+
+        Returns:
+            np.ndarray: the first observations
+        """
+        return self.venv.reset()
+
+    def step_wait(self):
+        """
+        Wait the step of all the environments and compute their rewards in one call
+
+        Returns:
+            observations (np.ndarray): the new observations
+            rewards (np.ndarray): the generated rewards
+            dones (np.ndarray): True if the episode is done
+            infos (list[dict]): additional information
+        """
+        observations, _, dones, infos = self.venv.step_wait()
+        rewarded_observations = observations
+        if dones.any():
+            # the reward is computed on the last observation of the episode, not on the reset one
+            rewarded_observations = observations.copy()
+            for i in np.flatnonzero(dones):
+                rewarded_observations[i] = infos[i]["terminal_observation"]
+        is_success = np.array([info.get("is_success", 0) for info in infos], dtype=bool)
+        is_failure = np.array([info.get("is_failure", 0) for info in infos], dtype=bool)
+        start = perf_counter() if self.profile else 0.0
+        rewards = np.asarray(
+            self.llm_reward_function(rewarded_observations, is_success, is_failure), dtype=np.float32
+        )
+        if self.profile:
+            self.timings["reward_func"] += perf_counter() - start
+        return observations, rewards, dones, infos
@@ -17,6 +17,8 @@ class State:
         reward_func_str (str, optional): String representation of the reward function.
         policy (object, optional): The policy associated with the reward function.
         performances (dict, optional): Performance metrics of the reward function.
+        parent (int, optional): Index of the state refined to create this one.
+        generation (dict, optional): Cost of the generation (attempts, repairs, samples, tokens, latency).
 
     Key Characteristics:
         - Tracks the evolution of reward functions
@@ -61,6 +63,7 @@ class State:
         reward_func_str: str = None,
         policy=None,
         perfomances: dict = None,
+        parent: int = None,
     ):
         """
         Initialize a new state in the reward function generation process.
@@ -71,6 +74,7 @@ class State:
             reward_func_str (str, optional): for printing the reward function. Defaults to None.
             policy (_type_, optional): . Defaults to None.
             perfomances (dict, optional): . Defaults to None.
+            parent (int, optional): the index of the refined state. Defaults to None.
         """
         self.idx = idx
         if self.idx == 0 and (reward_func is not None or reward_func_str is not None):
@@ -82,6 +86,8 @@ class State:
         self.policy = policy
         self.logger_csv = getLoggerCSV()
         self.performances = perfomances
+        self.parent = parent
+        self.generation = None
 
     def set_policy(self, policy):
         """
@@ -92,6 +98,25 @@ class State:
         """
         self.policy = policy
 
+    def set_parent(self, parent: int):
+        """
+        Set the index of the state refined to create this one
+
+        Args:
+            parent (int): the index of the parent state
+        """
+        self.parent = parent
+
+    def set_generation(self, generation: dict):
+        """
+        Set the cost of the generation of the reward function
+
+        Args:
+            generation (dict): the attempts, repairs, samples, tokens and latency of the generation
+        """
+        self.generation = generation
+        self.logger_csv.generation_to_csv(self)
+
     def set_performances(self, performances: dict):
         """
         Set the performances of the state
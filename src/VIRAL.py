@@ -1,14 +1,25 @@
+import hashlib
+import json
 import os
 import random
+import re
 from logging import getLogger
 
 from Environments import EnvType
 from LLM.ClientVideoLVLM import ClienVideoLVLM
-from LLM.GenCode import GenCode
+from LLM.CodeCache import CodeCache
+from LLM.GenCode import REWARD_FUNCTION_SCHEMA, STRUCTURED_RULE, GenCode
 from LLM.OllamaChat import OllamaChat
 from log.LoggerCSV import LoggerCSV
 from PolicyTrainer.PolicyTrainer import PolicyTrainer
+from PolicyTrainer.TrajectoryDataset import TrajectoryDataset
 from State.State import State
+from utils.utils import atomic_write, file_lock
+
+try:
+    from LLM.AsyncOllamaChat import AsyncOllamaChat
+except ImportError: # httpx is optional, the independent generations are then sent by threads or in sequence
+    AsyncOllamaChat = None
 
 
 class VIRAL:
@@ -25,6 +36,18 @@ class VIRAL:
         legacy_training: bool = True,
         options: dict = {},
         proxies: dict = None,
+        max_workers: int = None,
+        early_stopping: bool | dict = False,
+        profile: bool = False,
+        warm_start: bool = False,
+        code_cache: bool = False,
+        reuse_context: bool = False,
+        training_slots=None,
+        llm_limiter=None,
+        structured: bool = False,
+        prescreen: bool = False,
+        prescreen_cutoff: float = 0.5,
+        slow_reward_step: float = 1e-4,
     ):
         """
         Initialize VIRAL architecture for dynamic reward function generation
@@ -41,6 +64,18 @@ class VIRAL:
             legacy_training (bool, optional): Use legacy training. Defaults to True.
             options (dict, optional): LLM generation options. Defaults to {}.
             proxies (dict, optional): Proxy configuration. Defaults to None.
+            max_workers (int, optional): Maximum number of concurrent trainings. Defaults to nb_cores // nb_vec_envs.
+            early_stopping (bool | dict, optional): Stop the training of hopeless reward functions, a dict sets the rule (min_sr, min_evals, patience, min_delta, nb_evals, nb_episodes), see PolicyTrainer. Defaults to False.
+            profile (bool, optional): Measure where the training time is spent, and warn the LLM about slow reward functions. Defaults to False.
+            warm_start (bool, optional): Initialise refined policies from the policy of their parent. Defaults to False.
+            code_cache (bool, optional): Reuse the validations and the trainings of the reward functions already generated. Defaults to False.
+            reuse_context (bool, optional): Reuse the context generated by a previous run with the same environment, goal and critic. Defaults to False.
+            training_slots (SharedSlots, optional): Training slots shared with the concurrent runs of an ExperimentRunner. Defaults to None.
+            llm_limiter (SharedLimiter, optional): Bound of the LLM requests shared with the concurrent runs of an ExperimentRunner. Defaults to None.
+            structured (bool, optional): Constrain the actor to a JSON answer with the code of reward_func, parsed without guessing. Defaults to False.
+            prescreen (bool, optional): Score the reward functions on labelled trajectories of the environment before training them. Defaults to False.
+            prescreen_cutoff (float, optional): Score under which a reward function is not trained, 0.5 is a reward blind to the goal. Defaults to 0.5.
+            slow_reward_step (float, optional): With profile, seconds per timestep above which the LLM is warned that the reward function is slow. Defaults to 1e-4.
             
         """
         if seed is None:
@@ -60,9 +95,12 @@ class VIRAL:
         4. STOP immediately your completion after the last return
         5. Assuming Numpy already imported as np
         6. Take into the observation of the state, the is_success boolean flag, the is_failure boolean flag
-        """,
+        """ + (STRUCTURED_RULE if structured else ""),
             options=options.copy(),
-            proxies=proxies
+            proxies=proxies,
+            request_limiter=llm_limiter,
+            stop_after_code=not structured, # a JSON answer ends with the code
+            response_format=REWARD_FUNCTION_SCHEMA if structured else None,
         )
         self.llm_critic = OllamaChat(
             model=model_critic, #         You're an assistant in rewarding for the {env_type} environment
@@ -71,18 +109,25 @@ class VIRAL:
         As a critic, you're going to explains step by step, the environment.
         Every answer you make will be contained in an xml <HELP> tag.""",
             options=options.copy(),
-            proxies=proxies
+            proxies=proxies,
+            request_limiter=llm_limiter,
         )
         self.hf = hf
         self.vd = vd
+        self.reuse_context = reuse_context
         if self.vd:
             self.client_video = ClienVideoLVLM(proxies)
         self.env_type: EnvType = env_type
-        self.gen_code: GenCode = GenCode(self.env_type, self.llm_actor)
+        self.code_cache = CodeCache(str(env_type)) if code_cache else None
+        self.gen_code: GenCode = GenCode(self.env_type, self.llm_actor, self.code_cache, structured=structured)
         self.logger = getLogger("VIRAL")
         self.memory: list[State] = [State(0)]
         self.policy_trainer: PolicyTrainer = PolicyTrainer(
-            self.memory, options['seed'], self.env_type, timeout=training_time, nb_vec_envs=nb_vec_envs, legacy_training=legacy_training
+            self.memory, options['seed'], self.env_type, timeout=training_time, nb_vec_envs=nb_vec_envs, legacy_training=legacy_training,
+            max_workers=max_workers, early_stopping=early_stopping, profile=profile,
+            warm_start=warm_start, code_cache=self.code_cache, training_slots=training_slots,
+            trajectories=TrajectoryDataset(env_type) if prescreen else None, prescreen_cutoff=prescreen_cutoff,
+            slow_reward_step=slow_reward_step,
         )
 
     def generate_context(self):
@@ -96,14 +141,14 @@ class VIRAL:
             prompt += "Please, Describe precisely the red annotation in the Image, an the Observation Space. "
             prompt += "Remember to use what you see, as a grounding, as a link to the Observation Space. "
             prompt += f"Finally, Using your scientific knowledge, How the agent can achieve the following goal: \n{self.env_type.prompt['Goal']} ?"
-            self.llm_critic.add_message(prompt, images=[self.env_type.prompt["Image"]])
-            self.llm_actor.add_message(prompt, images=[self.env_type.prompt["Image"]])
+            self.llm_critic.add_message(prompt, images=[self.env_type.prompt["Image"]], pinned=True)
+            self.llm_actor.add_message(prompt, images=[self.env_type.prompt["Image"]], pinned=True)
         elif "Image" not in self.env_type.prompt.keys() and "Goal" in self.env_type.prompt.keys():
             prompt = f"<Observation Space>\n{self.env_type.prompt['Observation Space']}\n</Observation Space>\n"
             prompt += "Please, Describe precisely the Observation Space and "
             prompt += f"using your scientific knowledge, How the agent can achieve the following goal: \n{self.env_type.prompt['Goal']} ?"
-            self.llm_critic.add_message(prompt)
-            self.llm_actor.add_message(prompt)
+            self.llm_critic.add_message(prompt, pinned=True)
+            self.llm_actor.add_message(prompt, pinned=True)
         elif "Image" in self.env_type.prompt.keys() and "Goal" not in self.env_type.prompt.keys():
             prompt = "First, Describe precisely the red annotation, which explain the goal, in the Image by answering these question: "
             prompt += "Which are the annotation ? \n What is the meaning ? \n"
@@ -115,14 +160,73 @@ class VIRAL:
             # prompt += f"<Observation Space>\n{self.env_type.prompt['Observation Space']}\n</Observation Space>\n"
             # prompt += "Please, Describe precisely the red annotation in the Image, an the Observation Space. "
             # prompt += "Remember to use what you see, as a grounding, as a link to the Observation Space. "
-            self.llm_critic.add_message(prompt, images=[self.env_type.prompt["Image"]])
-            self.llm_actor.add_message(prompt, images=[self.env_type.prompt["Image"]])
-        response = self.llm_critic.generate_response(stream=True)
-        response = self.llm_critic.print_Generator_and_return(response, -1)
-        self.llm_actor.add_message(response)
+            self.llm_critic.add_message(prompt, images=[self.env_type.prompt["Image"]], pinned=True)
+            self.llm_actor.add_message(prompt, images=[self.env_type.prompt["Image"]], pinned=True)
+        context_path, context_key = self._context_cache_path(prompt)
+        response = self._load_context(context_path, context_key) if self.reuse_context else None
+        if response is None:
+            response = self.llm_critic.generate_response(stream=True)
+            response = self.llm_critic.print_Generator_and_return(response, -1)
+            self.logger.info(f"context generated, time to first token: {self.llm_critic.ttft}s")
+            self._save_context(context_path, context_key, response)
+        else:
+            self.logger.info(f"context reused from {context_path}")
+            self.llm_critic.add_message(response, role="assistant")
+        self.llm_critic.messages[-1]["pinned"] = True
+        self.llm_actor.add_message(response, pinned=True)
+
+    def _context_cache_path(self, prompt: str) -> tuple[str, str]:
+        """
+        Get the file and the key of the context of an environment
+
+        Args:
+            prompt (str): the context prompt, built from the observation space and the goal
+
+        Returns:
+            tuple[str, str]: the path of the context file of the environment, the key of the (prompt, image, critic) triple
+        """
+        safe_env_name = re.sub(r'[^a-zA-Z0-9_]', '_', str(self.env_type))
+        key = f"{self.llm_critic.model}\n{self.llm_critic.messages[0]['content']}\n{prompt}\n{self.env_type.prompt.get('Image')}"
+        return os.path.join("data", "context", f"{safe_env_name}.json"), hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _load_context(self, path: str, key: str) -> str:
+        """
+        Load the context saved by a previous run
+
+        Args:
+            path (str): the context file of the environment
+            key (str): the key of the context
+
+        Returns:
+            str: the critic response, None if unknown
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return json.load(file).get(key)
+
+    def _save_context(self, path: str, key: str, response: str) -> None:
+        """
+        Save the critic response of the context stage for the next runs
+
+        Args:
+            path (str): the context file of the environment
+            key (str): the key of the context
+            response (str): the critic response
+        """
+        if response == "":
+            return
+        with file_lock(path): # the parallel runs share the file
+            contexts = {}
+            if os.path.exists(path):
+                with open(path) as file:
+                    contexts = json.load(file)
+            contexts[key] = response
+            atomic_write(path, lambda file: json.dump(contexts, file, indent=2))
 
     def generate_reward_function(
-        self, n_init: int = 2, n_refine: int = 1, focus: str = ""
+        self, n_init: int = 2, n_refine: int = 1, focus: str = "", successive_halving: bool = False,
+        batch_init: bool = False, pipelined: bool = False, concurrent_refine: bool = False
     ) -> list[State]:
         """
         Generate and iteratively improve a reward function using a Language Model (LLM).
@@ -140,6 +244,18 @@ class VIRAL:
                                     for which the reward function is being generated.
             iterations (int, optional): Number of refinement iterations to perform.
                                         Defaults to 1.
+            successive_halving (bool, optional): Share the training budget of the initial
+                                        functions by successive halving, only the survivor
+                                        is evaluated. Defaults to False.
+            batch_init (bool, optional): Sample the initial functions with concurrent
+                                        requests on the same prompt instead of one
+                                        after the other. Defaults to False.
+            pipelined (bool, optional): Refine a worst function as soon as its training
+                                        is finished, while the others are still training.
+                                        Defaults to False.
+            concurrent_refine (bool, optional): Send the refinements of the worst functions
+                                        of a round at the same time, each with the history
+                                        before the round (needs httpx). Defaults to False.
 
         Returns:
             list[State]: A list of generated and refined reward function states,
@@ -172,8 +288,134 @@ class VIRAL:
             - Logging at various stages for debugging and tracking
         """
         ### INIT STAGE ###
-        for i in range(1, n_init + 1):
-            prompt = f"""Iteration {i}/{n_init},
+        if concurrent_refine and AsyncOllamaChat is None:
+            self.logger.warning("httpx is not installed, the refinements are sent one after the other")
+            concurrent_refine = False
+        self.policy_trainer.freeze_trajectories() # same prescreen for all the functions of an iteration
+        first_budget = None
+        if successive_halving:
+            first_budget = self.policy_trainer.halving_budgets(n_init)[0]
+        if batch_init:
+            self.llm_actor.add_message(self.init_prompt(f"One of {n_init} independent candidates", focus))
+            for state in self.generate_states(n_init):
+                self.policy_trainer.start_learning(state.idx, first_budget)
+        else:
+            for i in range(1, n_init + 1):
+                self.llm_actor.add_message(self.init_prompt(f"Iteration {i}/{n_init}", focus))
+                response = self.llm_actor.generate_response(stream=True)
+                response = self.llm_actor.print_Generator_and_return(
+                    response, len(self.memory) - 1
+                )
+                state = self.get_state(response)
+                if state is None:
+                    continue
+                self.memory.append(state)
+                self.policy_trainer.start_learning(state.idx, first_budget)
+        init_idx = [state.idx for state in self.memory[1:]]
+        if init_idx == []:
+            self.logger.error("no runnable initial reward function")
+            return self.memory
+
+        if pipelined:
+            candidates = init_idx
+            if successive_halving:
+                candidates = [self.policy_trainer.successive_halving(candidates)]
+            self.policy_trainer.freeze_trajectories()
+            self.pipelined_refine(candidates, n_refine)
+            are_worsts = [] # already refined
+        elif successive_halving:
+            survivor = self.policy_trainer.successive_halving(init_idx)
+            are_worsts, are_betters, threshold = self.policy_trainer.evaluate_policy([survivor])
+        else:
+            are_worsts, are_betters, threshold = self.policy_trainer.evaluate_policy(init_idx)
+        ### SECOND STAGE ###
+        for _ in range(n_refine):
+            if are_worsts == []:
+                break
+            self.logger.debug(f"states to refines: {are_worsts}")
+            self.policy_trainer.freeze_trajectories()
+            news_idx: list[int] = []
+            if concurrent_refine and len(are_worsts) > 1:
+                news_idx = self.refine_concurrently(are_worsts)
+            else:
+                for worst_idx in are_worsts:
+                    # if self.memory[worst_idx].performances["sr"] < threshold - 0.2:
+                        # news_idx.append(self.critical_refine_reward(worst_idx))
+                    # else:
+                    new_idx = self.self_refine_reward(worst_idx)
+                    if new_idx is not None:
+                        news_idx.append(new_idx)
+            are_worsts, are_betters, _ = self.policy_trainer.evaluate_policy(news_idx)
+        trained = [state for state in self.memory if state.policy is not None] # not prescreened or crashed
+        if trained == []:
+            self.logger.warning("no trained policy to record")
+            return self.memory
+        self.policy_trainer.start_vd(trained[-1].policy, 1)
+        video_path = os.path.join("records", str(self.env_type), f"{self.env_type}_{self.policy_trainer.seed}-last.mp4")
+        self.logger.info(f"video safe at: {video_path}")
+        return self.memory
+
+    def pipelined_refine(self, list_idx: list[int], n_refine: int = 1) -> None:
+        """
+        Refine the worst functions as soon as their training is finished, the LLM generates
+        while the other functions are still training. The functions are handled in the order
+        of their creation, whatever the order their trainings finish, so the refinements,
+        the history of the actor and the memory are the same for a given seed as in the refine
+        rounds of generate_reward_function: a worst function is refined if it is less than
+        n_refine refinements away from an initial function.
+
+        Args:
+            list_idx (list[int]): the indexes of the trained or training initial functions
+            n_refine (int, optional): the maximum number of successive refinements. Defaults to 1.
+        """
+        threshold = self.policy_trainer.get_threshold()
+        self.logger.info(f"the threshold is {threshold}")
+        depths = {idx: 0 for idx in list_idx}
+        queue = list(list_idx)
+        refined: list[int] = []
+        while queue:
+            idx = queue.pop(0) # the next trainings keep running meanwhile
+            for _ in self.policy_trainer.as_completed([idx]):
+                pass
+            if depths[idx] < n_refine and self.policy_trainer.is_worst(idx, threshold):
+                self.logger.debug(f"state to refine: {idx}, depth {depths[idx]}")
+                new_idx = self.self_refine_reward(idx)
+                if new_idx is None:
+                    continue
+                refined.append(idx)
+                depths[new_idx] = depths[idx] + 1
+                queue.append(new_idx)
+        self.logger.info(f"states refined: {refined}, states trained: {list(depths)}")
+
+    def get_state(self, response: str) -> State:
+        """
+        Get the state of a response, the response is skipped if GenCode finds
+        no runnable function within its repairs and samples
+
+        Args:
+            response (str): the response of the LLM
+
+        Returns:
+            State: the new state, None if skipped
+        """
+        try:
+            return self.gen_code.get(response)
+        except RuntimeError as e:
+            self.logger.error(f"reward function skipped: {e}")
+            return None
+
+    def init_prompt(self, header: str, focus: str = "") -> str:
+        """
+        Build the prompt of an initial reward function
+
+        Args:
+            header (str): the first line of the prompt, the iteration
+            focus (str, optional): the focus of the reward function. Defaults to "".
+
+        Returns:
+            str: the prompt
+        """
+        return f"""{header},
             {focus}
         Complete this sentence using the <HELP> section as a guide:
         def reward_func(observations:np.ndarray, is_success:bool, is_failure:bool) -> float:
@@ -188,34 +430,41 @@ class VIRAL:
                 float: The reward for the current step
             \"\"\"
         """
-            self.llm_actor.add_message(prompt)
-            response = self.llm_actor.generate_response(stream=True)
-            response = self.llm_actor.print_Generator_and_return(
-                response, len(self.memory) - 1
-            )
-            state: State = self.gen_code.get(response) #TODO if  response doesn't work the chat is stuck and regenate the same response over and over
-            self.memory.append(state)
-            self.policy_trainer.start_learning(state.idx)
 
-        are_worsts, are_betters, threshold = self.policy_trainer.evaluate_policy(
-            range(1, n_init + 1)
-        )
-        ### SECOND STAGE ###
-        for _ in range(n_refine):
-            if are_worsts == []:
-                break
-            self.logger.debug(f"states to refines: {are_worsts}")
-            news_idx: list[int] = []
-            for worst_idx in are_worsts:
-                # if self.memory[worst_idx].performances["sr"] < threshold - 0.2:
-                    # news_idx.append(self.critical_refine_reward(worst_idx))
-                # else:
-                news_idx.append(self.self_refine_reward(worst_idx))
-            are_worsts, are_betters, _ = self.policy_trainer.evaluate_policy(news_idx)
-        self.policy_trainer.start_vd(self.memory[-1].policy, 1)
-        video_path = os.path.join("records", str(self.env_type), f"{self.env_type}_{self.policy_trainer.seed}-last.mp4")
-        self.logger.info(f"video safe at: {video_path}")
-        return self.memory
+    def generate_states(self, k: int) -> list[State]:
+        """
+        Sample k reward functions for the last prompt with concurrent requests,
+        the wall-clock time is about the one of a single generation. Each response is
+        validated after the prompt alone, so its repairs and resamples do not see the
+        other responses. The history then keeps the prompt and the valid responses.
+
+        Args:
+            k (int): the number of reward functions
+
+        Returns:
+            list[State]: the new states, added to the memory, the unrunnable functions are skipped
+        """
+        if AsyncOllamaChat is None:
+            responses = self.llm_actor.generate_responses(k)
+        else:
+            batch = AsyncOllamaChat.from_chat(self.llm_actor)
+            responses = AsyncOllamaChat.run(batch.generate_responses(k))
+            self.llm_actor.prompt_tokens = batch.prompt_tokens # counted by GenCode
+        prompt_length = len(self.llm_actor.messages)
+        kept_messages = []
+        states = []
+        for response in responses:
+            del self.llm_actor.messages[prompt_length:] # the turns of the previous response
+            self.llm_actor.add_message(response, role="assistant")
+            self.logger.info(f"Response {len(self.memory) - 1}:\n{response}")
+            state = self.get_state(response)
+            if state is None:
+                continue
+            kept_messages += self.llm_actor.messages[prompt_length:]
+            self.memory.append(state)
+            states.append(state)
+        self.llm_actor.messages[prompt_length:] = kept_messages
+        return states
 
     def critical_refine_reward(self, idx: int) -> int:
         """
@@ -228,7 +477,7 @@ class VIRAL:
                     Typically the worst-performing function from previous evaluation.
         
         Returns:
-            int: Index of the newly created refined reward function in the memory.
+            int: Index of the newly created refined reward function in the memory, None if skipped.
         
         """
         self.logger.warning("critical refine reward")
@@ -259,6 +508,8 @@ class VIRAL:
                 float: The reward for the current step
             \"\"\"
         """
+        actor_prompt = self.slow_reward_feedback(actor_prompt, idx)
+        actor_prompt = self.prescreen_feedback(actor_prompt, idx)
         if self.hf:
             critic_prompt = self.human_feedback(critic_prompt, idx)
         self.llm_critic.add_message(critic_prompt)
@@ -272,7 +523,9 @@ class VIRAL:
         refined_response = self.llm_actor.print_Generator_and_return(
             refined_response, len(self.memory) - 1
         )
-        state = self.gen_code.get(refined_response)
+        state = self.get_state(refined_response)
+        if state is None:
+            return None
         self.memory.append(state)
         self.policy_trainer.start_learning(state.idx)
         return state.idx
@@ -295,7 +548,7 @@ class VIRAL:
                     Typically the worst-performing function from previous evaluation.
 
         Returns:
-            int: Index of the newly created refined reward function in the memory.
+            int: Index of the newly created refined reward function in the memory, None if skipped.
 
         Refinement Process:
             1. Construct a refinement prompt with:
@@ -318,6 +571,51 @@ class VIRAL:
             - Leverages LLM for intelligent function refinement
             - Provides a systematic approach to reward function improvement
             - Maintains a history of function iterations
+        """
+        self.llm_actor.add_message(self.refinement_prompt(idx))
+        refined_response = self.llm_actor.generate_response(stream=True)
+        refined_response = self.llm_actor.print_Generator_and_return(
+            refined_response, len(self.memory) - 1
+        )
+        return self.add_refined_state(idx, refined_response)
+
+    def refine_concurrently(self, list_idx: list[int]) -> list[int]:
+        """
+        Refine several worst functions with concurrent requests, each refinement prompt is sent
+        with the history before the round. The prompts and the responses are then added to the
+        history and the memory in the order of list_idx, whatever the order they arrive in.
+
+        Args:
+            list_idx (list[int]): the indexes of the functions to refine
+
+        Returns:
+            list[int]: the indexes of the refined functions in the memory, the skipped ones are missing
+        """
+        prompts = [self.refinement_prompt(idx) for idx in list_idx]
+        chats = [AsyncOllamaChat.from_chat(self.llm_actor) for _ in prompts]
+        for chat, prompt in zip(chats, prompts):
+            chat.add_message(prompt)
+        responses = AsyncOllamaChat.run(*(chat.generate_response() for chat in chats))
+        news_idx = []
+        for idx, prompt, chat, response in zip(list_idx, prompts, chats, responses):
+            self.llm_actor.add_message(prompt)
+            self.llm_actor.add_message(response, role="assistant")
+            self.llm_actor.prompt_tokens = chat.prompt_tokens # counted by GenCode
+            self.logger.info(f"Response {len(self.memory) - 1}:\n{response}")
+            new_idx = self.add_refined_state(idx, response)
+            if new_idx is not None:
+                news_idx.append(new_idx)
+        return news_idx
+
+    def refinement_prompt(self, idx: int) -> str:
+        """
+        Build the self-refinement prompt of a function, with the feedbacks on its training
+
+        Args:
+            idx (int): Index of the reward function in the memory to be refined.
+
+        Returns:
+            str: the prompt for the actor
         """# based on the provided performance metrics {self.memory[idx].performances}. 
         refinement_prompt = f"""Analyze the shortcomings of the current reward function {self.memory[idx].reward_func_str}
         base on the goal {self.env_type.prompt['Goal']}, identify specific issues that may have led to suboptimal performance.
@@ -325,20 +623,74 @@ class VIRAL:
         Include comments in the code to explain your reasoning and how the new function improves upon the previous one.
         """
         self.logger.debug(self.memory[idx].performances)
+        refinement_prompt = self.slow_reward_feedback(refinement_prompt, idx)
+        refinement_prompt = self.prescreen_feedback(refinement_prompt, idx)
         if self.hf:
             refinement_prompt = self.human_feedback(refinement_prompt, idx)
         if self.vd:
             refinement_prompt = self.video_description(refinement_prompt, idx)
-        self.llm_actor.add_message(refinement_prompt)
-        refined_response = self.llm_actor.generate_response(stream=True)
-        refined_response = self.llm_actor.print_Generator_and_return(
-            refined_response, len(self.memory) - 1
-        )
-        state = self.gen_code.get(refined_response)
+        return refinement_prompt
+
+    def add_refined_state(self, idx: int, refined_response: str) -> int:
+        """
+        Add the refinement of a function to the memory and start its training
+
+        Args:
+            idx (int): Index of the refined reward function in the memory.
+            refined_response (str): the response of the actor to the refinement prompt
+
+        Returns:
+            int: Index of the newly created refined reward function in the memory, None if skipped.
+        """
+        state = self.get_state(refined_response)
+        if state is None:
+            return None
+        state.set_parent(idx)
         self.memory.append(state)
         self.policy_trainer.start_learning(state.idx)
         return state.idx
 
+    def slow_reward_feedback(self, prompt: str, idx: int) -> str:
+        """
+        Warn the LLM if the profiling has flagged the reward function as slow.
+
+        Args:
+            prompt (str): The refinement prompt
+            idx (int): The index of the reward function in the memory
+
+        Returns:
+            str: The updated prompt with the timings if the reward function is slow
+        """
+        performances = self.memory[idx].performances
+        if performances is not None and performances.get("slow_reward_func", False):
+            prompt += f"""
+        The previous reward function is too slow: it took {performances['time_reward_func']:.1f}s
+        ({performances.get('time_reward_step', 0.0) * 1e6:.0f} microseconds per step)
+        against {performances['time_env_step']:.1f}s for the environment steps.
+        Avoid python loops over the observations, use simple numpy operations.
+        """
+        return prompt
+
+    def prescreen_feedback(self, prompt: str, idx: int) -> str:
+        """
+        Tell the LLM if the reward function has been rejected by the prescreen without training.
+
+        Args:
+            prompt (str): The refinement prompt
+            idx (int): The index of the reward function in the memory
+
+        Returns:
+            str: The updated prompt with the prescreen score if the reward function was not trained
+        """
+        performances = self.memory[idx].performances
+        if performances is not None and performances.get("prescreened", False):
+            prompt += f"""
+        The previous reward function was not trained: on recorded episodes, its returns do not separate
+        the successful episodes from the failed ones (score {performances['prescreen_score']:.2f}, 0.5 is chance).
+        The successful episodes must get a higher return than the failed ones.
+        """
+        return prompt
+
     def human_feedback(self, prompt: str, idx: int) -> str:
         """
         Request human feedback on a reward function to refine it further.
@@ -407,7 +759,9 @@ class VIRAL:
         Args:
             reward_func (str): The reward function to test
         """
-        state: State = self.gen_code.get(reward_func)
+        state = self.get_state(reward_func)
+        if state is None:
+            return
         self.memory.append(state)
         self.policy_trainer.start_learning(state.idx)
         are_worsts, are_betters, threshold = self.policy_trainer.evaluate_policy([state.idx])
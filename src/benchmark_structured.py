@@ -0,0 +1,168 @@
+import argparse
+import copy
+import json
+import os
+from logging import getLogger
+
+from Environments import CartPole, Highway, Hopper, LunarLander, Swimmer
+from Environments.EnvType import EnvType
+from LLM.GenCode import REWARD_FUNCTION_SCHEMA, STRUCTURED_RULE, GenCode
+from LLM.LLMOptions import llm_options
+from LLM.OllamaChat import OllamaChat
+from log.log_config import init_logger
+from log.LoggerCSV import LoggerCSV
+from VIRAL import VIRAL
+
+ENVIRONMENTS = {
+    "CartPole": CartPole,
+    "Highway": Highway,
+    "Hopper": Hopper,
+    "LunarLander": LunarLander,
+    "Swimmer": Swimmer,
+}
+
+
+def prompts_path(env_type: EnvType) -> str:
+    """
+    Get the path of the recorded prompts of an environment
+
+    Args:
+        env_type (EnvType): the environment
+
+    Returns:
+        str: the path in data/prompts
+    """
+    return os.path.join("data", "prompts", f"{env_type}.json")
+
+
+def record_prompts(env_type: EnvType, model: str, nb_prompts: int) -> str:
+    """
+    Record the messages sent to the actor for the initial reward functions,
+    after the generation of the context by the critic
+
+    Args:
+        env_type (EnvType): the environment
+        model (str): the LLM model of the actor and the critic
+        nb_prompts (int): the number of prompts
+
+    Returns:
+        str: the path of the recorded prompts
+    """
+    # no baseline training, only the generation is measured
+    viral = VIRAL(
+        env_type=env_type, model_actor=model, model_critic=model, options=llm_options,
+        reuse_context=True, legacy_training=False,
+    )
+    viral.generate_context()
+    prompts = []
+    for i in range(1, nb_prompts + 1):
+        messages = viral.llm_actor.get_context()
+        messages.append({"role": "user", "content": viral.init_prompt(f"Iteration {i}/{nb_prompts}")})
+        prompts.append([{key: value for key, value in message.items() if key != "pinned"} for message in messages])
+    path = prompts_path(env_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump({"model": model, "prompts": prompts}, file, indent=2)
+    getLogger("VIRAL").info(f"{nb_prompts} prompts recorded at: {path}")
+    return path
+
+
+def replay_prompts(env_type: EnvType, model: str, structured: bool, seed: int = 0) -> list[dict]:
+    """
+    Send every recorded prompt to the actor and make its answer runnable with GenCode
+
+    Args:
+        env_type (EnvType): the environment
+        model (str): the LLM model of the actor
+        structured (bool): constrain the answers to REWARD_FUNCTION_SCHEMA
+        seed (int, optional): the seed of the first prompt, the next prompts use the next seeds. Defaults to 0.
+
+    Returns:
+        list[dict]: the generation statistics of every prompt, with the runnable flag
+    """
+    with open(prompts_path(env_type)) as file:
+        prompts = json.load(file)["prompts"]
+    results = []
+    for i, messages in enumerate(prompts):
+        llm = OllamaChat(
+            model=model,
+            options={**llm_options, "seed": seed + i}, # same seeds in both modes
+            stop_after_code=not structured,
+            response_format=REWARD_FUNCTION_SCHEMA if structured else None,
+        )
+        llm.messages = copy.deepcopy(messages)
+        if structured and llm.messages[0]["role"] == "system":
+            llm.messages[0]["content"] += STRUCTURED_RULE
+        gen_code = GenCode(env_type, llm, structured=structured)
+        response = llm.print_Generator_and_return(llm.generate_response(stream=True), i)
+        try:
+            gen_code.get(response)
+            runnable = True
+        except RuntimeError:
+            runnable = False
+        results.append({**gen_code.generation, "runnable": runnable})
+    return results
+
+
+def summarize(results: list[dict]) -> dict:
+    """
+    Summarize the generation statistics of a mode
+
+    Args:
+        results (list[dict]): the generation statistics of every prompt
+
+    Returns:
+        dict: the number of prompts, of runnable functions, the LLM round trips after the first answer
+            (repairs and samples) and the mean latency
+    """
+    return {
+        "nb_prompts": len(results),
+        "nb_runnable": sum(result["runnable"] for result in results),
+        "repairs": sum(result["repairs"] for result in results),
+        "round_trips": sum(result["repairs"] + result["samples"] - 1 for result in results),
+        "mean_latency": sum(result["latency"] for result in results) / max(1, len(results)),
+    }
+
+
+def main():
+    """
+    Main entry point of the script.
+
+    Record the actor prompts of an environment, or replay them with and without
+    structured output and report the repair round trips saved by the structured output.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["record", "replay"])
+    parser.add_argument("--env", choices=list(ENVIRONMENTS.keys()), default="CartPole")
+    parser.add_argument("--model", default="qwen2.5-coder")
+    parser.add_argument("--nb-prompts", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose mode")
+    args = parser.parse_args()
+    init_logger("DEBUG" if args.verbose else "INFO")
+    logger = getLogger("VIRAL")
+
+    env_type = ENVIRONMENTS[args.env]()
+    if args.command == "record":
+        record_prompts(env_type, args.model, args.nb_prompts)
+        return
+
+    LoggerCSV(env_type, args.model, 0)
+    report = {}
+    for structured in (False, True):
+        results = replay_prompts(env_type, args.model, structured, args.seed)
+        report["structured" if structured else "plain"] = {**summarize(results), "prompts": results}
+    saved = report["plain"]["round_trips"] - report["structured"]["round_trips"]
+    report["saved_round_trips"] = saved
+    path = os.path.join("data", "benchmarks", f"structured_{env_type}.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+    for mode in ("plain", "structured"):
+        summary = {key: value for key, value in report[mode].items() if key != "prompts"}
+        logger.info(f"{mode}: {summary}")
+    logger.info(f"round trips saved by the structured output: {saved}, report saved at: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,12 @@ import gradio as gr
 
 import argparse
 import json
+from functools import partial
 from logging import getLogger
 from Environments import Algo, CartPole, Highway, Hopper, LunarLander, Swimmer
+from ExperimentRunner import ExperimentRunner, viral_run
 from LLM.LLMOptions import llm_options
 from log.log_config import init_logger
-from VIRAL import VIRAL
 
 
 def parse_logger():
@@ -72,24 +73,26 @@ def runs(
     if proxies != "":
         proxies_dict = json.loads(proxies)
 
-    def run():
-        viral = VIRAL(
-            env_type=instance,
-            model_actor=actor_model,
-            model_critic=critic_model,
-            hf=human_feedback,
-            vd=video_description,
-            nb_vec_envs=nb_vec_envs,
-            options=llm_options,
-            legacy_training=legacy_training,
-            training_time=total_timesteps,
-            proxies=proxies_dict,
-        )
-        viral.generate_context()
-        viral.generate_reward_function(nb_gen, nb_refined)  # TODO focus
-
-    for _ in range(nb_runs):
-        run()
+    viral_kwargs = dict(
+        env_type=instance,
+        model_actor=actor_model,
+        model_critic=critic_model,
+        hf=human_feedback,
+        vd=video_description,
+        nb_vec_envs=nb_vec_envs,
+        options=llm_options,
+        legacy_training=legacy_training,
+        training_time=total_timesteps,
+        proxies=proxies_dict,
+        reuse_context=True,
+    )
+    runner = ExperimentRunner(max_runs=nb_runs, cores_per_training=nb_vec_envs, max_llm_requests=1)
+    runner.run(
+        partial(viral_run, viral_kwargs=viral_kwargs, n_init=nb_gen, n_refine=nb_refined),  # TODO focus
+        nb_runs,
+        name=f"{instance}_{actor_model}",
+        interactive=human_feedback, # the feedback is read on the standard input
+    )
     return 
 
 
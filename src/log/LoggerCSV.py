@@ -1,10 +1,13 @@
 import csv
 import os
 import re
+from contextlib import contextmanager
 from logging import getLogger
+from typing import Generator
 
 from Environments import EnvType
 from LLM.LLMOptions import llm_options
+from utils.utils import file_lock
 
 
 def getLoggerCSV():
@@ -63,9 +66,32 @@ class LoggerCSV:
         safe_env_type = re.sub(r'[^a-zA-Z0-9_]', '_', str(env_type))
         self.llm = llm
         self.csv_file = f"data/{safe_env_type}_log.csv"
+        self.halving_csv_file = f"data/{safe_env_type}_halving_log.csv"
+        self.profile_csv_file = f"data/{safe_env_type}_profile_log.csv"
+        self.generation_csv_file = f"data/{safe_env_type}_generation_log.csv"
         self.logger = getLogger("VIRAL")
         self._initialized = True
 
+    @contextmanager
+    def _append(self, path: str, header: str) -> Generator:
+        """
+        Open a CSV file shared by the parallel runs to append rows, with the lock of the file
+        so the header is written once and the rows of two runs are not mixed
+
+        Args:
+            path (str): the path of the CSV file
+            header (str): the header line, written if the file does not exist
+
+        Yields:
+            the csv writer of the file
+        """
+        with file_lock(path):
+            if not os.path.exists(path):
+                with open(path, "w") as file:
+                    file.write(header + "\n")
+            with open(path, "a", newline="") as csvfile:
+                yield csv.writer(csvfile, delimiter=";")
+
     def to_csv(self, state):
         """
         Write performance metrics to the CSV file.
@@ -79,11 +105,7 @@ class LoggerCSV:
         if state.performances is None:
             self.logger.debug(f"State {state.idx} is not completed")
             raise ValueError(f"State {state.idx} is not completed")
-        if not os.path.exists(self.csv_file):
-            with open(self.csv_file, "w") as file:
-                file.write("path;env;llm;llm_param;algo;algo_param;total_timesteps;reward_function;rewards;mean_reward;std_reward;sr\n")
-        with open(self.csv_file, "a", newline="") as csvfile:
-            spamwriter = csv.writer(csvfile, delimiter=";")
+        with self._append(self.csv_file, "path;env;llm;llm_param;algo;algo_param;total_timesteps;reward_function;rewards;mean_reward;std_reward;sr") as spamwriter:
             spamwriter.writerow(
                 [
                     state.policy,
@@ -100,3 +122,81 @@ class LoggerCSV:
                     state.performances["sr"],
                 ]
             )
+        if "time_training" in state.performances:
+            self.profile_to_csv(state)
+
+    def profile_to_csv(self, state):
+        """
+        Write the profiling of a training to the profile CSV file.
+
+        Args:
+            state: The state object containing the durations in its performances.
+        """
+        with self._append(self.profile_csv_file, "path;env;llm;algo;total_timesteps;reward_function;time_training;time_env_step;time_reward_func;time_success_func;time_update;slow_reward_func") as spamwriter:
+            spamwriter.writerow(
+                [
+                    state.policy,
+                    self.env_type,
+                    self.llm,
+                    self.env_type.algo.value,
+                    self.total_timesteps,
+                    state.reward_func_str,
+                    state.performances["time_training"],
+                    state.performances["time_env_step"],
+                    state.performances["time_reward_func"],
+                    state.performances["time_success_func"],
+                    state.performances["time_update"],
+                    state.performances["slow_reward_func"],
+                ]
+            )
+
+    def generation_to_csv(self, state):
+        """
+        Write the cost of the generation of a reward function to the generation CSV file.
+
+        Args:
+            state: The state object containing the generation statistics.
+        """
+        with self._append(self.generation_csv_file, "idx;env;llm;reward_function;attempts;repairs;samples;prompt_tokens;latency;jit_speedup") as spamwriter:
+            spamwriter.writerow(
+                [
+                    state.idx,
+                    self.env_type,
+                    self.llm,
+                    state.reward_func_str,
+                    state.generation["attempts"],
+                    state.generation["repairs"],
+                    state.generation["samples"],
+                    state.generation["prompt_tokens"],
+                    state.generation["latency"],
+                    state.generation.get("jit_speedup"),
+                ]
+            )
+
+    def rung_to_csv(self, rung: int, budget: int, ranking: list, nb_survivors: int):
+        """
+        Write the ranking of a successive halving rung to the halving CSV file.
+
+        Args:
+            rung (int): The index of the rung.
+            budget (int): The number of timesteps added to each candidate at this rung.
+            ranking (list[State]): The candidates of the rung, from the best to the worst.
+            nb_survivors (int): The number of candidates kept for the next rung.
+        """
+        with self._append(self.halving_csv_file, "env;llm;algo;rung;budget;rank;state;path;sr;mean_reward;survivor") as spamwriter:
+            for rank, state in enumerate(ranking):
+                spamwriter.writerow(
+                    [
+                        self.env_type,
+                        self.llm,
+                        self.env_type.algo.value,
+                        rung,
+                        budget,
+                        rank,
+                        state.idx,
+                        state.policy,
+                        state.performances["sr"],
+                        state.performances["mean_reward"],
+                        rank < nb_survivors,
+                    ]
+                )
@@ -1,11 +1,12 @@
 import argparse
+from functools import partial
 from logging import getLogger
 
 from Environments import (Algo, CartPole, Highway, Hopper, LunarLander,
                           Swimmer)
+from ExperimentRunner import ExperimentRunner, viral_run
 from LLM.LLMOptions import llm_options
 from log.log_config import init_logger
-from VIRAL import VIRAL
 
 
 def parse_logger():
@@ -30,13 +31,18 @@ def parse_logger():
     return getLogger()
 
 
-def main():
+def main(nb_runs: int = 10) -> dict:
     """
     Main entry point of the script.
 
     This block is executed when the script is run directly. It initializes the
-    logger, and run VIRAL. It uses CLI interface.
-    memory.
+    logger, and run VIRAL nb_runs times in parallel. It uses CLI interface.
+
+    Args:
+        nb_runs (int, optional): the number of VIRAL runs. Defaults to 10.
+
+    Returns:
+        dict: the report of the runs
     """
     parse_logger()
     # env_type = LunarLander(
@@ -82,7 +88,7 @@ the x- and y-coordinates are returned in info with the keys "x_position" and "y_
         "http"  : "socks5h://localhost:1080", 
         "https" : "socks5h://localhost:1080", 
     }
-    viral = VIRAL(
+    viral_kwargs = dict(
         env_type=env_type,
         model_actor=actor,
         model_critic=critic,
@@ -93,19 +99,15 @@ the x- and y-coordinates are returned in info with the keys "x_position" and "y_
         legacy_training=False,
         training_time=500_000,
         proxies=proxies,
+        reuse_context=True,
+    )
+    runner = ExperimentRunner(max_runs=4, cores_per_training=viral_kwargs["nb_vec_envs"], max_llm_requests=1)
+    return runner.run(
+        partial(viral_run, viral_kwargs=viral_kwargs, n_init=1, n_refine=5),
+        nb_runs,
+        name=f"{env_type}_{actor}",
     )
-    viral.generate_context()
-    viral.generate_reward_function(n_init=1, n_refine=5)
-    for state in viral.memory:
-
-        if state.idx != 0 and viral.memory[0].performances['sr'] < state.performances['sr']:
-            count += 1
-        viral.logger.info(state)
-
-    return count
 
 if __name__ == "__main__":
-    fcount = 0
-    for i in range(10):
-        fcount += main()
-    print("final count", fcount)
+    report = main()
+    print("final count", report["sum"].get("nb_better", 0))
@@ -1,7 +1,59 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import IO, Callable, Generator
+
+try:
+    import fcntl
+except ImportError: # not on LINUX, the runs are not parallel
+    fcntl = None
+
+
 def unwrap_env(env):
     """
     Unwraps a gym environment to get the base env.
     """
     while hasattr(env, "env"):  # check if env is a wrapper
         env = unwrap_env(env.env)
-    return env
\ No newline at end of file
+    return env
+
+
+@contextmanager
+def file_lock(path: str) -> Generator[None, None, None]:
+    """
+    Hold an exclusive lock on a file shared by the parallel runs, to read, update and write it
+
+    Args:
+        path (str): the path of the shared file, the lock is taken on path + ".lock"
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def atomic_write(path: str, write: Callable[[IO], None], mode: str = "w") -> None:
+    """
+    Write a file through a unique temporary file, a reader never sees a partial file
+
+    Args:
+        path (str): the path of the file
+        write (Callable[[IO], None]): writes the content in the opened temporary file
+        mode (str, optional): the mode of the temporary file. Defaults to "w".
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as file:
+            write(file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise